@@ -13,3 +13,7 @@ with open("custom_settings.py","w") as fh:
     fh.write("DEBUG=" + str(DEBUG) + "\n")
     fh.write("ALLOWED_HOSTS = [\"localhost\"]\n")
     fh.write("REDIS_HOST = \"localhost\"\n")
+    fh.write("# \"redis\", or \"memory\" for a single server process without Redis\n")
+    fh.write("CHANNEL_LAYER_MODE = \"redis\"\n")
+    fh.write("# False when running the publish_tournament_updates command\n")
+    fh.write("PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT = True\n")
@@ -1,4 +1,6 @@
+from django.conf.urls import url
 from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import tmdb.routing
@@ -11,4 +13,9 @@ application = ProtocolTypeRouter({
     'websocket': AuthMiddlewareStack(
         URLRouter(tmdb.routing.websocket_urlpatterns)
     ),
+    # the event streams are read-only, so they skip the session and auth
+    # lookups; everything else is handled by Django
+    'http': URLRouter(tmdb.routing.http_urlpatterns + [
+        url(r'', AsgiHandler),
+    ]),
 })
@@ -14,6 +14,8 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 import os
 import sys
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Overwrite the default settings with custom settings, if they exist
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 current_dir = os.path.dirname(os.path.realpath("__file__"))
@@ -22,6 +24,14 @@ try:
     from .custom_settings import SECRET_KEY, DEBUG, ALLOWED_HOSTS, REDIS_HOST
 except:
     raise IOError("Unable to read configuration from custom settings")
+try:
+    from .custom_settings import CHANNEL_LAYER_MODE
+except ImportError:
+    CHANNEL_LAYER_MODE = "redis"
+try:
+    from .custom_settings import PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT
+except ImportError:
+    PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT = True
 sys.path.pop(0)
 
 
@@ -173,13 +183,70 @@ LOGGING = {
 LOGIN_REDIRECT_URL = '/tmdb/'
 LOGIN_URL = 'tmdb:login'
 
-CHANNEL_LAYERS = {
-    "default": {
+# REDIS_HOST may also be the path of the unix socket of a local Redis
+# server, which saves the TCP round trips when everything runs on one machine.
+if REDIS_HOST.startswith("/"):
+    REDIS_ADDRESS = REDIS_HOST
+    REDIS_CACHE_LOCATION = "unix://%s?db=1" %(REDIS_HOST,)
+else:
+    REDIS_ADDRESS = (REDIS_HOST, 6379)
+    REDIS_CACHE_LOCATION = "redis://%s:6379/1" %(REDIS_HOST,)
+
+# CHANNEL_LAYER_MODE (set in custom_settings) selects how match updates are
+# passed between consumers:
+#   "redis"   through Redis, which works with any number of server processes
+#   "memory"  within the one server process, without Redis. Only use this
+#             when running a single server process (e.g. one daphne on a
+#             laptop), and leave PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT set
+#             to True, since the publish_tournament_updates command cannot
+#             reach the server process.
+# See the benchmark_channel_layer command for how they compare.
+CHANNEL_LAYER_BACKENDS = {
+    "redis": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [(REDIS_HOST, 6379)],
+            "hosts": [REDIS_ADDRESS],
         },
     },
+    "memory": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+if CHANNEL_LAYER_MODE not in CHANNEL_LAYER_BACKENDS:
+    raise ImproperlyConfigured(
+            "Invalid CHANNEL_LAYER_MODE in custom settings: %r (must be one of %s)" %(
+            CHANNEL_LAYER_MODE, ", ".join(sorted(CHANNEL_LAYER_BACKENDS))))
+
+CHANNEL_LAYERS = {
+    "default": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_MODE],
 }
 
 ASGI_APPLICATION = 'ectc_tm_server.routing.application'
+
+# Tournament snapshots are cached in Redis so that they are shared by all
+# server processes (channels uses database 0 of the same server). A single
+# process keeps them in its own memory instead.
+if CHANNEL_LAYER_MODE == "memory":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_CACHE_LOCATION,
+        },
+    }
+
+# PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT (set in custom_settings, True by
+# default) is whether match updates are broadcast by the server process which
+# made them as soon as their transaction commits. Set it to False when
+# running the publish_tournament_updates command, which broadcasts them from
+# the TournamentUpdate table instead.
+
+# The most times per second the spectator websockets are sent the changes
+# to a tournament (see SpectatorConsumer in tmdb/consumers.py).
+SPECTATOR_UPDATES_PER_SECOND = 2
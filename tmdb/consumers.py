@@ -1,76 +1,762 @@
+import asyncio
 import json
+import logging
+from collections import deque, OrderedDict
+from urllib.parse import parse_qs
 
-from django.core import serializers
-from django.db.models.signals import post_save, post_delete
+import msgpack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.dispatch import receiver
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 from . import models
-from .views.tournament_view import json_fields
-
-def match_updates_group_name(tournament_slug):
-    return "match-updates-%s" %(tournament_slug,)
-
-def create_message(message_type, message_content, dump_message_content=True):
-    if dump_message_content:
-        message_content = json.dumps(message_content)
-    return json.dumps({
-            'message_type': message_type,
-            'message_content': message_content})
-
-@receiver([post_save, post_delete], sender=models.SparringTeamMatch,
-        dispatch_uid="update_team_match")
-def update_team_match(sender, instance, **kwargs):
-    team_match_json = json.loads(serializers.serialize('json', [instance],
-            fields = json_fields['team_match']))
-    tournament_slug = instance.division.tournament.slug
-    group_name = match_updates_group_name(tournament_slug)
-    async_to_sync(get_channel_layer().group_send)(group_name, {
-        'type': 'update_sparring_team_match',
-        'message': create_message('update', team_match_json,
-            dump_message_content=False)
-    })
-
-class SparringTeamMatchConsumer(WebsocketConsumer):
-    def connect(self):
+from .snapshot import compact_row, get_snapshot_json, get_snapshot_msgpack, \
+        packb, COMPACT_FORMAT, COMPACT_FORMAT_VERSION
+
+logger = logging.getLogger(__name__)
+
+def match_updates_group_name(tournament_slug, subscription_key=None):
+    """Returns the name of the group which receives all of the updates of a
+    tournament, or only those for subscription_key (see
+    models.TournamentUpdate)."""
+    if subscription_key is None:
+        return "match-updates-%s" %(tournament_slug,)
+    return "match-updates-%s-%s" %(tournament_slug, subscription_key)
+
+# Clients which offer this websocket subprotocol are sent every message as
+# a binary MessagePack frame instead of JSON text.
+MSGPACK_SUBPROTOCOL = 'tmdb.msgpack'
+
+# the start of the MessagePack encoding of
+# {"message_type": "snapshot", "message_content": <snapshot>}
+SNAPSHOT_MSGPACK_PREFIX = b'\x82' + packb('message_type') + packb('snapshot') \
+        + packb('message_content')
+
+@receiver(models.tournament_updated, dispatch_uid="broadcast_tournament_update")
+def broadcast_tournament_update(sender, tournament_id, tournament_updates,
+        **kwargs):
+    tournament_slug = models.Tournament.objects.filter(
+            pk=tournament_id).values_list('slug', flat=True).first()
+    if tournament_slug is None:
+        return
+    group_send = async_to_sync(get_channel_layer().group_send)
+    updates_by_group = OrderedDict()
+    updates_by_group[match_updates_group_name(tournament_slug)] = \
+            tournament_updates
+    for tournament_update in tournament_updates:
+        for subscription_key in tournament_update.get_subscription_keys():
+            group_name = match_updates_group_name(tournament_slug,
+                    subscription_key)
+            updates_by_group.setdefault(group_name, []).append(
+                    tournament_update)
+    for group_name, group_updates in updates_by_group.items():
+        message = models.TournamentUpdate.batch_message_json(group_updates)
+        group_send(group_name, {
+            'type': 'update_sparring_team_match',
+            'seq': group_updates[-1].sequence,
+            'message': message,
+            'message_msgpack': models.TournamentUpdate.batch_message_msgpack(
+                    group_updates),
+        })
+
+def _parse_ring_number(value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("Invalid ring number: %s" %(value,))
+    return value
+
+def _parse_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError("Invalid value: %s" %(value,))
+    return value
+
+def _parse_team_id(value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("Invalid team: %s" %(value,))
+    return value
+
+# the fields of a match which clients may set, with the attname each one is
+# written to and the function which validates its value
+MATCH_PATCH_FIELDS = {
+    'ring_number': ('ring_number', _parse_ring_number),
+    'in_holding': ('in_holding', _parse_bool),
+    'at_ring': ('at_ring', _parse_bool),
+    'competing': ('competing', _parse_bool),
+    'winning_team': ('winning_team_id', _parse_team_id),
+}
+
+MAX_REQUEST_ID_LENGTH = 64
+
+def load_patch_message(text_data=None, bytes_data=None):
+    """Decodes a message of patches sent by a client as JSON text, or as
+    MessagePack by clients of MSGPACK_SUBPROTOCOL. The message is either a
+    request
+
+        {"request_id": "...", "patches": [...]}
+
+    or just the list of patches. Returns (request id, list of patches),
+    where the request id is None if there is none. Raises ValueError if the
+    message cannot be decoded."""
+    try:
+        if bytes_data is not None:
+            message = msgpack.unpackb(bytes_data, raw=False)
+        else:
+            message = json.loads(text_data)
+    except Exception:
+        raise ValueError("Invalid message")
+    request_id = None
+    raw_patches = message
+    if isinstance(message, dict) and 'patches' in message:
+        request_id = message.get('request_id')
+        if request_id is not None and (not isinstance(request_id, str)
+                or not request_id
+                or len(request_id) > MAX_REQUEST_ID_LENGTH):
+            raise ValueError("Invalid request id")
+        raw_patches = message['patches']
+    if isinstance(raw_patches, dict):
+        raw_patches = [raw_patches]
+    if not isinstance(raw_patches, list):
+        raise ValueError("Invalid message")
+    return request_id, raw_patches
+
+def parse_match_patches(raw_patches):
+    """Parses a list of match patches sent by a client, e.g.
+
+        [{"op": "set", "match_id": 3, "field": "ring_number", "value": 2,
+          "version": 4, "client_seq": 7}, ...]
+
+    and returns them as a list of (match id, {field attname: value}, version)
+    for models.SparringTeamMatch.update_matches(), with the patches of each
+    match merged. version is the version of the match the client saw, and
+    may be left out. Raises ValueError if any of the patches is invalid.
+    """
+    patches = OrderedDict()
+    versions = {}
+    for raw_patch in raw_patches:
+        if not isinstance(raw_patch, dict) or raw_patch.get('op') != 'set':
+            raise ValueError("Invalid patch")
+        match_id = raw_patch.get('match_id')
+        if isinstance(match_id, bool) or not isinstance(match_id, int):
+            raise ValueError("Invalid match: %s" %(match_id,))
+        patch_field = MATCH_PATCH_FIELDS.get(raw_patch.get('field'))
+        if patch_field is None:
+            raise ValueError("%s cannot be changed" %(raw_patch.get('field'),))
+        field_attname, parse_value = patch_field
+        patches.setdefault(match_id, {})[field_attname] = parse_value(
+                raw_patch.get('value'))
+        version = raw_patch.get('version')
+        if version is not None:
+            if isinstance(version, bool) or not isinstance(version, int):
+                raise ValueError("Invalid version: %s" %(version,))
+            versions.setdefault(match_id, version)
+    return [(match_id, fields, versions.get(match_id))
+            for match_id, fields in patches.items()]
+
+def patch_client_seqs(raw_patches):
+    """Returns the client_seqs of raw_patches, for echoing them back in an
+    error message."""
+    return [raw_patch['client_seq'] for raw_patch in raw_patches
+            if isinstance(raw_patch, dict) and 'client_seq' in raw_patch]
+
+# How long the answer to a request is remembered, so that a client which
+# sends the request again (e.g. after reconnecting) is answered without the
+# patches being applied twice.
+REQUEST_DEDUP_TIMEOUT = 10 * 60
+REQUEST_PENDING = 'pending'
+
+def request_cache_key(tournament_slug, request_id):
+    return "tmdb-request:%s:%s" %(tournament_slug, request_id)
+
+# The most database operations run at the same time by the consumers of one
+# server process. Further messages wait for a free slot instead of each
+# taking a thread (and a database connection) of their own.
+MAX_CONCURRENT_DATABASE_OPERATIONS = 8
+_database_semaphore = None
+
+async def run_database_operation(func, *args):
+    global _database_semaphore
+    if _database_semaphore is None:
+        _database_semaphore = asyncio.Semaphore(
+                MAX_CONCURRENT_DATABASE_OPERATIONS)
+    async with _database_semaphore:
+        return await database_sync_to_async(func)(*args)
+
+class SparringTeamMatchConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        """Joins the groups of the subscriptions given by the ring, division
+        and school query parameters, or the group of the whole tournament if
+        there are none."""
         self.tournament_slug = self.scope['url_route']['kwargs']['tournament_slug']
-        self.sparring_team_match_group = match_updates_group_name(
-                self.tournament_slug)
-        async_to_sync(self.channel_layer.group_add)(
-                self.sparring_team_match_group, self.channel_name)
-        self.accept()
+        query = parse_qs(self.scope['query_string'].decode())
+        subscription_keys = models.TournamentUpdate.parse_subscription_keys(
+                query)
+        if subscription_keys:
+            self.sparring_team_match_groups = [match_updates_group_name(
+                    self.tournament_slug, subscription_key)
+                    for subscription_key in subscription_keys]
+        else:
+            self.sparring_team_match_groups = [match_updates_group_name(
+                    self.tournament_slug)]
+        for group_name in self.sparring_team_match_groups:
+            await self.channel_layer.group_add(group_name, self.channel_name)
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get(
+                'subprotocols', ())
+        await self.accept(MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
+        if query.get('snapshot') == ['1']:
+            await self.send_snapshot()
+
+    async def send_message(self, message):
+        """Sends message, a dict, in the format negotiated by the client."""
+        if self.use_msgpack:
+            await self.send(bytes_data=packb(message))
+        else:
+            await self.send(text_data=json.dumps(message,
+                    cls=DjangoJSONEncoder))
+
+    async def send_snapshot(self):
+        """Sends the compact snapshot of the tournament as a "snapshot"
+        message.
+
+        This is done after joining the group, so every update after the seq
+        of the snapshot is also delivered to this client (and the ones it
+        already reflects can be dropped by seq)."""
+        snapshot_data = await run_database_operation(self.get_snapshot_data)
+        if snapshot_data is None:
+            await self.send_message({
+                'message_type': 'error',
+                'message_content': "Unknown tournament: %s" %(
+                        self.tournament_slug,),
+            })
+            return
+        if self.use_msgpack:
+            await self.send(bytes_data=SNAPSHOT_MSGPACK_PREFIX + snapshot_data)
+        else:
+            await self.send(text_data='{"message_type": "snapshot", "message_content": %s}' %(
+                    snapshot_data,))
+
+    def get_snapshot_data(self):
+        tournament = models.Tournament.objects.filter(
+                slug=self.tournament_slug).first()
+        if tournament is None:
+            return None
+        if self.use_msgpack:
+            return get_snapshot_msgpack(tournament)
+        return get_snapshot_json(tournament, 'compact')
+
+    async def disconnect(self, close_code):
+        for group_name in self.sparring_team_match_groups:
+            await self.channel_layer.group_discard(group_name,
+                    self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            request_id, raw_patches = load_patch_message(text_data,
+                    bytes_data)
+        except ValueError as e:
+            await self.send_message({
+                'message_type': 'error',
+                'message_content': str(e),
+                'client_seqs': [],
+            })
+            return
+        answer = await run_database_operation(self.handle_request,
+                request_id, raw_patches)
+        if answer is not None:
+            await self.send_message(answer)
+
+    def handle_request(self, request_id, raw_patches):
+        """Applies the patches of a request once and returns the message to
+        answer it with: an "ack", or an error.
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-                self.sparring_team_match_group, self.channel_name)
+        The answer is kept in the cache for REQUEST_DEDUP_TIMEOUT seconds
+        under the tournament and request_id, so when the same request is
+        received again (by any server process), the patches are not applied
+        again and the same answer is returned. None is returned for a
+        request which is still being applied, as that one will be answered.
+        """
+        cache_key = None
+        if request_id is not None:
+            cache_key = request_cache_key(self.tournament_slug, request_id)
+            if not cache.add(cache_key, REQUEST_PENDING,
+                    REQUEST_DEDUP_TIMEOUT):
+                answer = cache.get(cache_key)
+                if answer == REQUEST_PENDING:
+                    return None
+                return answer
+        try:
+            answer = self.apply_update_message(raw_patches)
+        except BaseException:
+            # let the retries of the request apply it again
+            if cache_key is not None:
+                cache.delete(cache_key)
+            raise
+        if answer is None:
+            answer = {'message_type': 'ack'}
+        answer['request_id'] = request_id
+        answer['client_seqs'] = patch_client_seqs(raw_patches)
+        if cache_key is not None:
+            cache.set(cache_key, answer, REQUEST_DEDUP_TIMEOUT)
+        return answer
 
-    def receive(self, text_data):
+    def apply_update_message(self, raw_patches):
+        """Checks the permissions of the user and applies the patches of an
+        update message. Returns an error message, or None if the update was
+        applied.
+
+        A conflict (see models.SparringTeamMatch.update_matches()) is
+        reported with the error "conflict" and the current rows of the
+        conflicting matches, in the columns of the compact snapshot."""
         if not self.scope['user'].has_perm('tmdb.change_sparringteammatch'):
             err_msg = str(self.scope['user'])
             err_msg += " does not have permission to change this value"
-            self.send(create_message('error', err_msg))
-            return
+            return {'message_type': 'error', 'message_content': err_msg}
         try:
-            SparringTeamMatchConsumer.process_update_message(text_data)
+            SparringTeamMatchConsumer.process_update_message(raw_patches)
+        except models.MatchConflictError as e:
+            return {
+                'message_type': 'error',
+                'error': 'conflict',
+                'message_content': str(e),
+                'model': 'tmdb_sparringteammatch',
+                'rows': [compact_row('team_match', match)
+                        for match in e.matches],
+            }
         except Exception as e:
-            self.send(create_message('error', str(e)))
-            return
+            return {'message_type': 'error', 'message_content': str(e)}
+        return None
 
-    def update_sparring_team_match(self, event):
-        message = event['message']
-        self.send(text_data=message)
+    async def update_sparring_team_match(self, event):
+        if self.use_msgpack:
+            await self.send(bytes_data=event['message_msgpack'])
+        else:
+            await self.send(text_data=event['message'])
 
     @staticmethod
-    def process_update_message(text_data):
-        raw_msgs = json.loads(text_data)
-        parsed_msgs = serializers.deserialize('json', text_data)
-        for raw_msg, parsed_msg in zip(raw_msgs, parsed_msgs):
-            model_class = type(parsed_msg.object)
-            model_instance = model_class.objects.get(pk=parsed_msg.object.pk)
-            for model_attr in raw_msg['fields'].keys():
-                model_attr_value = getattr(parsed_msg.object, model_attr)
-                setattr(model_instance, model_attr, model_attr_value)
-            model_instance.clean()
-            model_instance.save()
+    def process_update_message(raw_patches):
+        models.SparringTeamMatch.update_matches(
+                parse_match_patches(raw_patches))
+
+class SpectatorHub():
+    """The state of a tournament shared by the spectators connected to one
+    server process.
+
+    The hub is the only member of the tournament's update group in the
+    process, however many spectators there are. It keeps the compact
+    snapshot of the tournament in memory, applies the update batches to it,
+    and sends the rows which changed to every spectator at most
+    SPECTATOR_UPDATES_PER_SECOND times per second, as a single batch which
+    is encoded once for all of them. Spectators which join are sent the
+    snapshot from memory.
+    """
+    def __init__(self, tournament_slug):
+        self.tournament_slug = tournament_slug
+        self.spectators = set()
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        self.ready = asyncio.Event()
+        # the exception which start() failed with, if it did
+        self.error = None
+        self.stopped = False
+        self.tasks = []
+        # {table name: {'columns': columns, 'rows': {pk: row}}}, or None if
+        # there is no such tournament
+        self.tables = None
+        self.seq = None
+        # the updates and deletes since the last batch, by (table name, pk)
+        self.pending_changes = OrderedDict()
+        self.pending_first_seq = None
+        self.snapshot_frames = {}
+
+    async def start(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(
+                match_updates_group_name(self.tournament_slug),
+                self.channel_name)
+        await self.load_snapshot()
+        self.tasks = [asyncio.ensure_future(self.receive_updates()),
+                asyncio.ensure_future(self.send_updates())]
+        for task in self.tasks:
+            task.add_done_callback(self.on_task_done)
+        self.ready.set()
+
+    async def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        for task in self.tasks:
+            task.cancel()
+        if self.channel_name is not None:
+            await self.channel_layer.group_discard(
+                    match_updates_group_name(self.tournament_slug),
+                    self.channel_name)
+
+    def on_task_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error("Spectator hub of %s failed", self.tournament_slug,
+                exc_info=task.exception())
+        asyncio.ensure_future(self.shut_down())
+
+    async def shut_down(self):
+        """Stops the hub after a failure and disconnects its spectators,
+        which start a new hub when they reconnect."""
+        discard_spectator_hub(self)
+        await self.stop()
+        await asyncio.gather(*[spectator.close()
+                for spectator in list(self.spectators)],
+                return_exceptions=True)
+
+    async def load_snapshot(self):
+        snapshot_json = await run_database_operation(self.get_snapshot_json)
+        self.pending_changes.clear()
+        self.pending_first_seq = None
+        self.snapshot_frames = {}
+        if snapshot_json is None:
+            self.tables = None
+            return
+        snapshot = json.loads(snapshot_json)
+        self.seq = snapshot['seq']
+        self.tables = {}
+        for table_name, table in snapshot['tables'].items():
+            self.tables[table_name] = {
+                'columns': table['columns'],
+                'rows': OrderedDict((row[0], row) for row in table['rows']),
+            }
+
+    def get_snapshot_json(self):
+        tournament = models.Tournament.objects.filter(
+                slug=self.tournament_slug).first()
+        if tournament is None:
+            return None
+        return get_snapshot_json(tournament, 'compact')
+
+    async def receive_updates(self):
+        while True:
+            event = await self.channel_layer.receive(self.channel_name)
+            if event.get('type') != 'update_sparring_team_match' \
+                    or self.tables is None:
+                continue
+            message = json.loads(event['message'])
+            if message['seq'] <= self.seq:
+                continue
+            if message['first_seq'] > self.seq + 1:
+                # some updates were missed
+                await self.load_snapshot()
+                await self.send_all(self.snapshot_message(), self.snapshot_frames)
+                continue
+            self.apply_message(message)
+            if self.pending_first_seq is None:
+                self.pending_first_seq = self.seq + 1
+            self.seq = message['seq']
+            self.snapshot_frames = {}
+
+    def apply_message(self, message):
+        if message['message_type'] == models.TournamentUpdate.BATCH:
+            for sub_message in message['message_content']:
+                self.apply_message(sub_message)
+            return
+        table = self.tables.setdefault(message['model'],
+                {'columns': None, 'rows': OrderedDict()})
+        if message['message_type'] == models.TournamentUpdate.UPDATE:
+            for row in message['message_content']:
+                table['rows'][row[0]] = row
+                self.pending_changes.pop((message['model'], row[0]), None)
+                self.pending_changes[(message['model'], row[0])] = (
+                        models.TournamentUpdate.UPDATE, row)
+        else:
+            for pk in message['message_content']:
+                table['rows'].pop(pk, None)
+                self.pending_changes.pop((message['model'], pk), None)
+                self.pending_changes[(message['model'], pk)] = (
+                        models.TournamentUpdate.DELETE, pk)
+
+    async def send_updates(self):
+        updates_per_second = getattr(settings, 'SPECTATOR_UPDATES_PER_SECOND',
+                2)
+        while True:
+            await asyncio.sleep(1 / updates_per_second)
+            if not self.pending_changes:
+                continue
+            message = {
+                'message_type': models.TournamentUpdate.BATCH,
+                'first_seq': self.pending_first_seq,
+                'seq': self.seq,
+                'message_content': [{
+                    'message_type': message_type,
+                    'model': table_name,
+                    'message_content': [content],
+                } for (table_name, pk), (message_type, content)
+                        in self.pending_changes.items()],
+            }
+            self.pending_changes = OrderedDict()
+            self.pending_first_seq = None
+            await self.send_all(message, {})
+
+    def snapshot_message(self):
+        if self.tables is None:
+            return {
+                'message_type': 'error',
+                'message_content': "Unknown tournament: %s" %(
+                        self.tournament_slug,),
+            }
+        return {
+            'message_type': 'snapshot',
+            'message_content': {
+                'format': COMPACT_FORMAT,
+                'version': COMPACT_FORMAT_VERSION,
+                'seq': self.seq,
+                'tables': {table_name: {
+                    'columns': table['columns'],
+                    'rows': list(table['rows'].values()),
+                } for table_name, table in self.tables.items()},
+            },
+        }
+
+    async def send_snapshot(self, spectator):
+        await spectator.send_frame(self.snapshot_message(),
+                self.snapshot_frames)
+
+    async def send_all(self, message, frames):
+        """Sends message to every spectator. frames holds the encodings of
+        message (see SpectatorConsumer.send_frame()), so that it is encoded
+        at most once per format."""
+        await asyncio.gather(*[spectator.send_frame(message, frames)
+                for spectator in list(self.spectators)],
+                return_exceptions=True)
+
+_spectator_hubs = {}
+
+def discard_spectator_hub(hub):
+    if _spectator_hubs.get(hub.tournament_slug) is hub:
+        del _spectator_hubs[hub.tournament_slug]
+
+async def join_spectator_hub(tournament_slug, spectator):
+    """Adds spectator to the SpectatorHub of the tournament, which is
+    started by its first spectator.
+
+    If the hub fails to start, the exception is raised for every spectator
+    waiting for it, and the next spectator starts a new hub."""
+    hub = _spectator_hubs.get(tournament_slug)
+    if hub is None:
+        hub = SpectatorHub(tournament_slug)
+        _spectator_hubs[tournament_slug] = hub
+        hub.spectators.add(spectator)
+        try:
+            await hub.start()
+        except BaseException as e:
+            discard_spectator_hub(hub)
+            hub.error = e
+            hub.ready.set()
+            await asyncio.shield(hub.stop())
+            raise
+    else:
+        hub.spectators.add(spectator)
+        await hub.ready.wait()
+        if hub.error is not None:
+            hub.spectators.discard(spectator)
+            raise RuntimeError("The spectator hub of %s failed to start" %(
+                    tournament_slug,)) from hub.error
+    return hub
+
+async def leave_spectator_hub(hub, spectator):
+    """Removes spectator from hub, which is stopped when its last spectator
+    leaves."""
+    hub.spectators.discard(spectator)
+    if hub.spectators:
+        return
+    discard_spectator_hub(hub)
+    await hub.ready.wait()
+    await hub.stop()
+
+class SpectatorConsumer(AsyncWebsocketConsumer):
+    """A read-only connection for spectator screens.
+
+    Spectators are sent the snapshot of the tournament when they connect,
+    then batches of the rows which changed, at most
+    SPECTATOR_UPDATES_PER_SECOND times per second (see SpectatorHub). The
+    messages are the same as those of SparringTeamMatchConsumer, in JSON or
+    MessagePack."""
+    async def connect(self):
+        self.tournament_slug = self.scope['url_route']['kwargs']['tournament_slug']
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get(
+                'subprotocols', ())
+        self.hub = None
+        await self.accept(MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
+        self.hub = await join_spectator_hub(self.tournament_slug, self)
+        await self.hub.send_snapshot(self)
+        if self.hub.tables is None:
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if self.hub is not None:
+            await leave_spectator_hub(self.hub, self)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        await self.send_frame({
+            'message_type': 'error',
+            'message_content': "Spectators cannot change matches",
+        }, {})
+
+    async def send_frame(self, message, frames):
+        """Sends message, encoded in the format of this spectator. The
+        encoding is kept in frames, which is shared by the spectators the
+        same message is sent to."""
+        if self.use_msgpack:
+            if 'msgpack' not in frames:
+                frames['msgpack'] = packb(message)
+            await self.send(bytes_data=frames['msgpack'])
+        else:
+            if 'json' not in frames:
+                frames['json'] = json.dumps(message, separators=(',', ':'))
+            await self.send(text_data=frames['json'])
+
+# How often a comment is sent on an idle event stream, so that proxies do not
+# close it.
+EVENT_STREAM_KEEPALIVE_INTERVAL = 15
+# How long browsers wait before reconnecting to a closed event stream, in ms
+EVENT_STREAM_RETRY = 5000
+# How long after an update, in seconds, all of the updates before it are
+# assumed to have arrived. The groups of a subscription are not ordered among
+# each other, so their updates may arrive out of order within this time.
+UPDATE_REORDER_WINDOW = 5
+
+class MatchUpdateEventsConsumer(AsyncHttpConsumer):
+    """Streams the match updates of a tournament as Server-Sent Events, for
+    display screens which only receive data.
+
+    Every event is a message of SparringTeamMatchConsumer (in JSON). A new
+    stream starts with the snapshot of the tournament. A stream which is
+    reconnected with a Last-Event-ID header starts with the updates after
+    that seq instead (or the snapshot, if they are no longer kept). The
+    ring, division and school query parameters subscribe to the same groups
+    as for the websocket.
+
+    Updates of different groups may arrive out of order, so they are sent
+    as they arrive (clients apply them per row, see apply_message() in
+    match_websocket.js), and the id of an event is the highest seq sent at
+    least UPDATE_REORDER_WINDOW seconds before it rather than its own.
+    """
+    async def handle(self, body):
+        self.tournament_slug = self.scope['url_route']['kwargs']['tournament_slug']
+        query = parse_qs(self.scope['query_string'].decode())
+        self.subscription_keys = \
+                models.TournamentUpdate.parse_subscription_keys(query)
+        if self.subscription_keys:
+            self.group_names = [match_updates_group_name(
+                    self.tournament_slug, subscription_key)
+                    for subscription_key in self.subscription_keys]
+        else:
+            self.group_names = [match_updates_group_name(
+                    self.tournament_slug)]
+        # the seq up to which the initial events include every update
+        self.initial_seq = None
+        # the highest seq which can be resumed from (see next_event_id())
+        self.settled_seq = None
+        # (time, seq) of the events sent within UPDATE_REORDER_WINDOW
+        self.recent_seqs = deque()
+        self.keepalive_task = None
+
+        # joined first, so that no update is missed while the stream starts
+        for group_name in self.group_names:
+            await self.channel_layer.group_add(group_name, self.channel_name)
+        last_event_id = dict(self.scope['headers']).get(b'last-event-id')
+        initial_events = await run_database_operation(
+                self.get_initial_events, last_event_id)
+        if initial_events is None:
+            await self.send_response(404, b"Unknown tournament",
+                    headers=[(b'Content-Type', b'text/plain')])
+            await self.leave_groups()
+            raise StopConsumer()
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'),
+        ])
+        await self.send_body(b'retry: %d\n\n' %(EVENT_STREAM_RETRY,),
+                more_body=True)
+        for seq, message in initial_events:
+            await self.send_event(seq, message)
+        self.keepalive_task = asyncio.ensure_future(self.send_keepalives())
+
+    def get_initial_events(self, last_event_id):
+        """Returns the (seq, message) events a stream starts with after
+        last_event_id, or None if there is no such tournament."""
+        tournament = models.Tournament.objects.filter(
+                slug=self.tournament_slug).first()
+        if tournament is None:
+            return None
+        updates = None
+        if last_event_id is not None:
+            try:
+                updates = models.TournamentUpdate.updates_since(tournament,
+                        int(last_event_id), self.subscription_keys)
+            except ValueError:
+                pass
+        self.initial_seq = self.settled_seq = tournament.snapshot_version
+        if updates is None:
+            return [(tournament.snapshot_version,
+                    '{"message_type": "snapshot", "message_content": %s}' %(
+                    get_snapshot_json(tournament, 'compact'),))]
+        if not updates:
+            return []
+        return [(tournament.snapshot_version,
+                models.TournamentUpdate.batch_message_json(updates))]
+
+    def next_event_id(self, seq):
+        """Returns the id of an event which includes the update seq: the
+        highest seq sent at least UPDATE_REORDER_WINDOW seconds ago, after
+        which every update still to come is assumed to follow. A stream
+        resumed from it may repeat some updates, which clients drop."""
+        now = asyncio.get_event_loop().time()
+        self.recent_seqs.append((now, seq))
+        while now - self.recent_seqs[0][0] >= UPDATE_REORDER_WINDOW:
+            self.settled_seq = max(self.settled_seq,
+                    self.recent_seqs.popleft()[1])
+        return self.settled_seq
+
+    async def send_event(self, seq, message):
+        await self.send_body(('id: %d\ndata: %s\n\n' %(
+                self.next_event_id(seq), message)).encode('utf-8'),
+                more_body=True)
+
+    async def send_keepalives(self):
+        while True:
+            await asyncio.sleep(EVENT_STREAM_KEEPALIVE_INTERVAL)
+            await self.send_body(b': keepalive\n\n', more_body=True)
+
+    async def update_sparring_team_match(self, event):
+        if self.initial_seq is not None and event['seq'] <= self.initial_seq:
+            # already included in the initial events
+            return
+        await self.send_event(event['seq'], event['message'])
+
+    async def http_request(self, message):
+        # AsyncHttpConsumer (in channels 2.3, which requirements.txt pins, as
+        # well as 2.4) stops the consumer as soon as handle() returns. This
+        # one keeps running once the response has been started, until the
+        # client disconnects.
+        if "body" in message:
+            self.body.append(message["body"])
+        if not message.get("more_body"):
+            await self.handle(b"".join(self.body))
+
+    async def leave_groups(self):
+        for group_name in getattr(self, 'group_names', ()):
+            await self.channel_layer.group_discard(group_name,
+                    self.channel_name)
+
+    async def disconnect(self):
+        if getattr(self, 'keepalive_task', None) is not None:
+            self.keepalive_task.cancel()
+        await self.leave_groups()
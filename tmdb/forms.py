@@ -26,7 +26,7 @@ class SeasonDeleteForm(forms.ModelForm):
 class TournamentEditForm(forms.ModelForm):
     class Meta:
         model = models.Tournament
-        exclude = ['slug', 'imported']
+        exclude = ['slug', 'imported', 'snapshot_version']
 
 class TournamentDeleteForm(forms.ModelForm):
     class Meta:
@@ -35,6 +35,10 @@ class TournamentDeleteForm(forms.ModelForm):
 
 class TournamentImportForm(forms.ModelForm):
     team_file = forms.FileField()
+    incremental = forms.BooleanField(required=False, initial=False,
+            label="Only apply changes to existing teams",
+            help_text="Keeps the seeds and points of teams that did not"
+                    + " change instead of re-creating every team.")
 
     class Meta:
         model = models.Tournament
@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+import asyncio
+import json
+import random
+import time
+
+from tmdb.consumers import match_updates_group_name
+
+def make_channel_layer(mode):
+    config = settings.CHANNEL_LAYER_BACKENDS[mode]
+    return import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+
+def generate_message(seq, ring_number):
+    """Returns a broadcast event like those of a match update (see
+    broadcast_tournament_update())."""
+    row = [seq, 11, 12, None, 3, 1, 1, 100 + seq, None, ring_number, 2,
+            seq % 2, 0, 1]
+    message = json.dumps({
+        'message_type': 'batch', 'first_seq': seq, 'seq': seq,
+        'message_content': [{'message_type': 'update',
+                'model': 'tmdb_sparringteammatch', 'message_content': [row]}],
+    }, separators=(',', ':'))
+    return {'type': 'update_sparring_team_match', 'seq': seq,
+            'message': message}
+
+class RingTableLoad():
+    """A tournament with num_rings ring tables, each subscribed to its ring,
+    and num_spectators screens subscribed to the whole tournament."""
+    def __init__(self, channel_layer, num_rings, num_spectators):
+        self.channel_layer = channel_layer
+        self.num_rings = num_rings
+        self.num_spectators = num_spectators
+        self.tournament_slug = "benchmark-%d" %(random.randrange(1 << 30),)
+        self.expected = {}
+        self.done = {}
+
+    async def start(self):
+        self.receivers = []
+        self.memberships = []
+        groups = [match_updates_group_name(self.tournament_slug,
+                "ring-%d" %(ring_number,))
+                for ring_number in range(1, self.num_rings + 1)]
+        groups += [match_updates_group_name(self.tournament_slug)] \
+                * self.num_spectators
+        for group_name in groups:
+            channel_name = await self.channel_layer.new_channel()
+            await self.channel_layer.group_add(group_name, channel_name)
+            self.memberships.append((group_name, channel_name))
+            self.receivers.append(asyncio.ensure_future(
+                    self.receive(channel_name)))
+
+    async def stop(self):
+        for receiver in self.receivers:
+            receiver.cancel()
+        for group_name, channel_name in self.memberships:
+            await self.channel_layer.group_discard(group_name, channel_name)
+
+    async def receive(self, channel_name):
+        while True:
+            event = await self.channel_layer.receive(channel_name)
+            seq = event['seq']
+            self.expected[seq] -= 1
+            if self.expected[seq] == 0:
+                self.done[seq].set_result(time.perf_counter())
+
+    async def broadcast(self, seq, ring_number):
+        """Sends an update of a match at ring_number like
+        broadcast_tournament_update() does, and returns the seconds until
+        every subscriber has received it."""
+        event = generate_message(seq, ring_number)
+        self.expected[seq] = self.num_spectators + 1
+        self.done[seq] = asyncio.get_event_loop().create_future()
+        start_time = time.perf_counter()
+        await self.channel_layer.group_send(
+                match_updates_group_name(self.tournament_slug), event)
+        await self.channel_layer.group_send(
+                match_updates_group_name(self.tournament_slug,
+                "ring-%d" %(ring_number,)), event)
+        end_time = await asyncio.wait_for(self.done[seq], 10)
+        return end_time - start_time
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1,
+            int(len(sorted_values) * fraction))]
+
+class Command(BaseCommand):
+    help = 'Measures the broadcast latency of the channel layers under a simulated ring table load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--layers', default="memory,redis",
+                help="Comma separated CHANNEL_LAYER_MODEs to measure")
+        parser.add_argument('-r', '--rings', type=int, default=8,
+                help="Number of ring tables")
+        parser.add_argument('-s', '--spectators', type=int, default=20,
+                help="Number of spectator screens")
+        parser.add_argument('-n', '--num-updates', type=int, default=500,
+                help="Number of match updates to broadcast")
+        parser.add_argument('-i', '--interval', type=float, default=0,
+                help="Seconds between updates")
+
+    def handle(self, *args, **options):
+        for mode in options['layers'].split(','):
+            if mode not in settings.CHANNEL_LAYER_BACKENDS:
+                raise CommandError("Unknown channel layer mode: %s" %(mode,))
+            try:
+                latencies = asyncio.get_event_loop().run_until_complete(
+                        self.measure(make_channel_layer(mode), options))
+            except Exception as e:
+                self.stderr.write("%s: unable to measure: %s" %(mode, e))
+                continue
+            latencies.sort()
+            self.stdout.write("%s: %d updates to %d rings and %d spectators,"
+                    " p50: %.2fms, p95: %.2fms, max: %.2fms" %(mode,
+                    len(latencies), options['rings'], options['spectators'],
+                    percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.95) * 1000,
+                    latencies[-1] * 1000))
+
+    async def measure(self, channel_layer, options):
+        load = RingTableLoad(channel_layer, options['rings'],
+                options['spectators'])
+        await load.start()
+        rand = random.Random(0)
+        latencies = []
+        try:
+            for seq in range(1, options['num_updates'] + 1):
+                latencies.append(await load.broadcast(seq,
+                        rand.randint(1, options['rings'])))
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+        finally:
+            await load.stop()
+        return latencies
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from io import BytesIO
+import random
+import time
+
+from tmdb.util.team_file_importer import DIVISION_NAMES, parse_team_file
+
+def generate_team_file(num_rows, num_schools=50, seed=0):
+    """Returns the bytes of a synthetic team file with num_rows teams in
+    every division."""
+    rand = random.Random(seed)
+    lines = [",".join('"%s"' %(division_name,)
+            for division_name in DIVISION_NAMES)]
+    lines.append(",".join("%d Teams" %(num_rows,)
+            for division_name in DIVISION_NAMES))
+    lines.append("," * (len(DIVISION_NAMES) - 1))
+    for row_num in range(num_rows):
+        school_name = "Synthetic School %d" %(row_num % num_schools,)
+        team_num = row_num // num_schools + 1
+        cells = []
+        for division_name in DIVISION_NAMES:
+            composition = "".join(weight_class for weight_class in "LMH"
+                    if rand.random() < 0.8)
+            cells.append('"%s %s%d - (%s)"' %(school_name, division_name,
+                    team_num, composition))
+        lines.append(",".join(cells))
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+class Command(BaseCommand):
+    help = 'Measures team file parsing throughput on a synthetic team file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--num-rows', type=int, default=10000,
+                help="Number of team rows in the synthetic file")
+        parser.add_argument('-r', '--repeat', type=int, default=5,
+                help="Number of times to parse the file")
+
+    def handle(self, *args, **options):
+        num_rows = options['num_rows']
+        team_file_data = generate_team_file(num_rows)
+        # Division lookups are stubbed out so that only parsing is measured
+        # (and the benchmark does not need any tournament in the database).
+        get_sparring_division = lambda division_name: division_name
+
+        timings = []
+        for _ in range(options['repeat']):
+            start_time = time.perf_counter()
+            teams = parse_team_file(BytesIO(team_file_data),
+                    get_sparring_division=get_sparring_division)
+            timings.append(time.perf_counter() - start_time)
+        num_teams = sum(len(division_teams)
+                for division_teams in teams.values())
+        best_time = min(timings)
+        self.stdout.write("Parsed %d rows (%d teams, %d bytes)" %(
+                num_rows, num_teams, len(team_file_data)))
+        self.stdout.write("best: %.3fs, mean: %.3fs, %.0f rows/s" %(
+                best_time, sum(timings) / len(timings), num_rows / best_time))
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+# tmdb.consumers connects the receiver which sends the updates to the
+# channel layer
+import tmdb.consumers
+from tmdb.models import TournamentUpdate
+
+class Command(BaseCommand):
+    help = 'Broadcasts the unpublished TournamentUpdates to the websocket clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=500,
+                help="Maximum number of updates to publish at a time")
+        parser.add_argument('-i', '--interval', type=float, default=0.2,
+                help="Seconds to wait when there is nothing to publish")
+        parser.add_argument('--once', action='store_true',
+                help="Publish the pending updates and exit")
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'CHANNEL_LAYER_MODE', 'redis') == 'memory':
+            raise CommandError("The in-memory channel layer cannot reach the"
+                    + " server process. Set PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT"
+                    + " instead.")
+        batch_size = options['batch_size']
+        while True:
+            try:
+                num_published = TournamentUpdate.publish_pending(
+                        batch_size=batch_size)
+            except Exception as e:
+                self.stderr.write("Unable to publish updates: %s" %(e,))
+                num_published = 0
+            if num_published:
+                self.stdout.write("Published %d updates" %(num_published,))
+            if num_published < batch_size:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
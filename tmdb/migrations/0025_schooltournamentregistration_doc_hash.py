@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0024_allow_null_registration_doc_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schooltournamentregistration',
+            name='registration_doc_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
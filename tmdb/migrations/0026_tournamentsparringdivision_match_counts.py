@@ -0,0 +1,37 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:20
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+def count_matches(apps, schema_editor):
+    TournamentSparringDivision = apps.get_model(
+            "tmdb", "TournamentSparringDivision")
+    tournament_divisions = TournamentSparringDivision.objects.annotate(
+            match_count=Count('sparringteammatch'),
+            completed_match_count=Count('sparringteammatch',
+                    filter=Q(sparringteammatch__winning_team__isnull=False)))
+    for tournament_division in tournament_divisions:
+        tournament_division.num_matches = tournament_division.match_count
+        tournament_division.num_matches_completed = \
+                tournament_division.completed_match_count
+        tournament_division.save()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0025_schooltournamentregistration_doc_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentsparringdivision',
+            name='num_matches',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tournamentsparringdivision',
+            name='num_matches_completed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0026_tournamentsparringdivision_match_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournament',
+            name='snapshot_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0027_tournament_snapshot_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TournamentUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('message_type', models.CharField(max_length=16)),
+                ('message_content', models.TextField()),
+                ('tournament', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='tmdb.Tournament')),
+            ],
+            options={
+                'unique_together': {('tournament', 'sequence')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:25
+
+from django.db import migrations, models
+
+def mark_published(apps, schema_editor):
+    # updates recorded before the outbox existed were broadcast already
+    TournamentUpdate = apps.get_model("tmdb", "TournamentUpdate")
+    TournamentUpdate.objects.update(published=True)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0028_tournamentupdate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentupdate',
+            name='published',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_published, migrations.RunPython.noop),
+    ]
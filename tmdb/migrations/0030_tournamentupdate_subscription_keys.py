@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0029_tournamentupdate_published'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentupdate',
+            name='subscription_keys',
+            field=models.TextField(default=''),
+        ),
+    ]
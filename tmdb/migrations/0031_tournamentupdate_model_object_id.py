@@ -0,0 +1,32 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:41
+
+from django.db import migrations, models
+
+def delete_tournament_updates(apps, schema_editor):
+    # the content of the recorded updates is in the old format; clients which
+    # ask for them get the whole snapshot instead
+    TournamentUpdate = apps.get_model("tmdb", "TournamentUpdate")
+    TournamentUpdate.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0030_tournamentupdate_subscription_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_tournament_updates,
+                migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='tournamentupdate',
+            name='model',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tournamentupdate',
+            name='object_id',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+    ]
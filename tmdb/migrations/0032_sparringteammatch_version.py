@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-19 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0031_tournamentupdate_model_object_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparringteammatch',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-19 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0032_sparringteammatch_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tournament',
+            name='snapshot_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
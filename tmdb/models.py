@@ -1,14 +1,40 @@
+from django.conf import settings
 from django.db import models, transaction
+from django.db.models import Case, Count, F, Max, ProtectedError, Q, \
+        Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver, Signal
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
+from collections import defaultdict, OrderedDict
+from io import BytesIO
 from itertools import product
+import json
+import logging
+import threading
 from django.template.defaultfilters import slugify
 
-from tmdb.util import BracketGenerator, SlotAssigner, parse_team_file
+from tmdb.util import BracketGenerator, SlotAssigner, parse_team_file, \
+        TeamFileFormatError
+from tmdb.util.registration_source import get_registration_source
 from .school_registration_validator import SchoolRegistrationValidator
 
+logger = logging.getLogger(__name__)
+
 class SchoolValidationError(IntegrityError): pass
 
+class TeamRegistrationInUseError(ValueError):
+    """Raised when an import would remove team registrations which have
+    already won matches."""
+
+class MatchConflictError(Exception):
+    """Raised when matches were changed by someone else since the version
+    an update was based on. matches are the matches as they are now."""
+    def __init__(self, message, matches):
+        super().__init__(message)
+        self.matches = matches
+
 class SexField(models.CharField):
     FEMALE = 'F'
     MALE = 'M'
@@ -173,6 +199,16 @@ class Season(models.Model):
     def tournaments(self):
         return Tournament.objects.filter(season=self)
 
+class TeamRegistrationImportSummary():
+    def __init__(self, inserted=0, updated=0, deleted=0):
+        self.inserted = inserted
+        self.updated = updated
+        self.deleted = deleted
+
+    def __str__(self):
+        return "%d teams added, %d teams changed, %d teams removed" %(
+                self.inserted, self.updated, self.deleted,)
+
 class Tournament(models.Model):
     slug = models.SlugField(unique=True)
     season = models.ForeignKey(Season, on_delete=models.PROTECT)
@@ -180,6 +216,8 @@ class Tournament(models.Model):
     date = models.DateField()
     registration_doc_url = models.URLField(unique=True)
     imported = models.BooleanField(default=False)
+    # only written by bump_snapshot_version()
+    snapshot_version = models.PositiveIntegerField(default=0, editable=False)
 
     def validate_season(self):
         if self.season.start_date < self.date < self.season.end_date:
@@ -204,6 +242,17 @@ class Tournament(models.Model):
         self.full_clean()
         new_tournament = not self.id
 
+        if not new_tournament and not kwargs.get('force_insert'):
+            # The snapshot_version of this instance may be out of date, and
+            # writing it back would make the versions of later changes
+            # collide with those already recorded.
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field
+                        in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [field_name for field_name
+                    in update_fields if field_name != 'snapshot_version']
+
         super(Tournament, self).save(*args, **kwargs)
 
         if new_tournament:
@@ -228,13 +277,128 @@ class Tournament(models.Model):
     def __repr__(self):
         return self.slug if self.slug else self.slugify()
 
-    def import_school_registrations(self, team_file):
-        SparringTeamRegistration.objects.filter(
-                tournament_division__tournament=self).delete()
+    @staticmethod
+    def bump_snapshot_version(tournament_id, increment=1):
+        """Adds increment to the snapshot_version of a tournament and returns
+        the new value.
+
+        snapshot_version identifies the state of the data in the tournament
+        snapshot (see tmdb.snapshot); it is bumped whenever that data
+        changes.
+        """
+        with transaction.atomic():
+            Tournament.objects.filter(pk=tournament_id).update(
+                    snapshot_version=F('snapshot_version') + increment)
+            return Tournament.objects.filter(pk=tournament_id).values_list(
+                    'snapshot_version', flat=True).first()
+
+    @staticmethod
+    def bump_snapshot_versions(query_set):
+        """Increments the snapshot_version of every tournament in query_set
+        (see bump_snapshot_version())."""
+        Tournament.objects.filter(pk__in=query_set.values('pk')).update(
+                snapshot_version=F('snapshot_version') + 1)
+
+    def import_school_registrations(self, team_file, incremental=False):
+        """Imports the SparringTeamRegistrations listed in team_file.
+
+        By default, all existing registrations for this tournament are
+        deleted and recreated from the file. If incremental is set, the file
+        is diffed against the existing registrations instead (see
+        sync_team_registrations()) so that seeds, points and match
+        assignments of unchanged teams are preserved.
+        """
         teams = parse_team_file(team_file)
-        for division, teams in teams.items():
-            for team in teams:
+        if incremental:
+            return self.sync_team_registrations(teams)
+        with transaction.atomic():
+            SparringTeamRegistration.objects.filter(
+                    tournament_division__tournament=self).delete()
+            num_inserted = 0
+            for division, division_teams in teams.items():
+                for team in division_teams:
+                    self.import_team(team)
+                    num_inserted += 1
+        return TeamRegistrationImportSummary(inserted=num_inserted)
+
+    @staticmethod
+    def _team_registration_key(school_name, division_id, team_num):
+        return (school_name, division_id, team_num)
+
+    def sync_team_registrations(self, teams, school=None):
+        """Applies the difference between teams and the database.
+
+        teams is the output of parse_team_file(). Registrations are keyed by
+        (school, division, team number): keys that only exist in teams are
+        inserted, keys whose L/M/H composition changed are updated in place
+        and keys that only exist in the database are deleted. Registrations
+        that did not change are not written at all.
+
+        If school is given, only registrations of that school are compared
+        (and entries of other schools in teams are ignored).
+        """
+        existing_registrations = SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self).select_related(
+                'team__school', 'tournament_division')
+        if school is not None:
+            existing_registrations = existing_registrations.filter(
+                    team__school=school)
+        existing_by_key = {}
+        for registration in existing_registrations:
+            key = self._team_registration_key(registration.team.school.name,
+                    registration.tournament_division.division_id,
+                    registration.team.number)
+            existing_by_key[key] = registration
+
+        imported_by_key = {}
+        for division_teams in teams.values():
+            for team in division_teams:
+                if school is not None and team['school_name'] != school.name:
+                    continue
+                key = self._team_registration_key(team['school_name'],
+                        team['sparring_division'].id, team['team_num'])
+                imported_by_key[key] = team
+
+        inserted = [team for key, team in imported_by_key.items()
+                if key not in existing_by_key]
+        updated = []
+        for key, team in imported_by_key.items():
+            registration = existing_by_key.get(key)
+            if registration is None:
+                continue
+            composition = (team['has_lightweight'], team['has_middleweight'],
+                    team['has_heavyweight'])
+            if composition == (registration.lightweight,
+                    registration.middleweight, registration.heavyweight):
+                continue
+            (registration.lightweight, registration.middleweight,
+                    registration.heavyweight) = composition
+            updated.append(registration)
+        deleted = [registration.pk for key, registration
+                in existing_by_key.items() if key not in imported_by_key]
+
+        with transaction.atomic():
+            if deleted:
+                try:
+                    SparringTeamRegistration.objects.filter(
+                            pk__in=deleted).delete()
+                except ProtectedError as e:
+                    winning_team_ids = set(match.winning_team_id
+                            for match in e.protected_objects)
+                    raise TeamRegistrationInUseError(
+                            "Unable to remove teams which have already won matches: %s" %(
+                            ", ".join(sorted(str(registration.team)
+                                    for registration in existing_by_key.values()
+                                    if registration.pk in winning_team_ids)),))
+            if updated:
+                SparringTeamRegistration.objects.bulk_update(updated,
+                        ['lightweight', 'middleweight', 'heavyweight'])
+                # bulk_update() does not send post_save
+                Tournament.bump_snapshot_version(self.pk)
+            for team in inserted:
                 self.import_team(team)
+        return TeamRegistrationImportSummary(inserted=len(inserted),
+                updated=len(updated), deleted=len(deleted))
 
     def import_team(self, team):
         school = School.objects.get_or_create(name=team['school_name'])[0]
@@ -243,8 +407,7 @@ class Tournament(models.Model):
         school_tournament_registration = SchoolTournamentRegistration.objects.get_or_create(
                 tournament=self,
                 school_season_registration=school_season_registration,
-                registration_doc_url = None,
-                imported=True)[0]
+                defaults={'registration_doc_url': None, 'imported': True})[0]
         sparring_team = SparringTeam.objects.get_or_create(school=school,
                 division=team['sparring_division'],
                 number=team['team_num'])[0]
@@ -299,6 +462,8 @@ class SchoolTournamentRegistration(models.Model):
     tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE)
     school_season_registration = models.ForeignKey(SchoolSeasonRegistration, on_delete=models.PROTECT)
     registration_doc_url = models.URLField(null=True, blank=True, unique=False)
+    registration_doc_hash = models.CharField(max_length=64, blank=True,
+            default='')
     imported = models.BooleanField(default=False)
 
     class Meta:
@@ -308,11 +473,81 @@ class SchoolTournamentRegistration(models.Model):
         return '%s at %s' %(self.school_season_registration.school,
                 self.tournament)
 
+    def validate_teams(self, teams):
+        school = self.school_season_registration.school
+        errors = []
+        for division_name, division_teams in teams.items():
+            for team in division_teams:
+                if team['school_name'] == school.name:
+                    continue
+                error_text = "%s team #%d belongs to `%s`, not `%s`. Remove it from the registration document." %(
+                        division_name, team['team_num'], team['school_name'],
+                        school.name)
+                errors.append(SchoolTournamentRegistrationError(
+                        school_registration=self, error_text=error_text))
+        return errors
+
+    def import_competitors_and_teams(self, reimport=False, document=None):
+        """Imports the teams of this school from its registration document.
+
+        document is a RegistrationDocument; it is fetched from the
+        configured registration source if not given. If the document has
+        not changed since the last import, it is neither parsed nor
+        validated and False is returned. Otherwise the teams of this school
+        are synchronized with the document (see
+        Tournament.sync_team_registrations()) and True is returned.
+
+        Raises SchoolValidationError (after recording the errors as
+        SchoolTournamentRegistrationErrors) if the document is invalid or
+        removes teams which have already won matches.
+        """
+        if self.imported and not reimport:
+            return False
+        if document is None:
+            document = get_registration_source().fetch_document(self)
+        if self.imported and document.content_hash == self.registration_doc_hash:
+            return False
+
+        try:
+            teams = parse_team_file(BytesIO(document.content))
+        except TeamFileFormatError as e:
+            teams = {}
+            errors = [SchoolTournamentRegistrationError(
+                    school_registration=self, error_text=str(e))]
+        else:
+            errors = self.validate_teams(teams)
+
+        with transaction.atomic():
+            SchoolTournamentRegistrationError.objects.filter(
+                    school_registration=self).delete()
+            if not errors:
+                try:
+                    with transaction.atomic():
+                        self.tournament.sync_team_registrations(teams,
+                                school=self.school_season_registration.school)
+                except TeamRegistrationInUseError as e:
+                    errors = [SchoolTournamentRegistrationError(
+                            school_registration=self, error_text=str(e))]
+            if errors:
+                SchoolTournamentRegistrationError.objects.bulk_create(errors)
+                self.imported = False
+                self.registration_doc_hash = ''
+            else:
+                self.imported = True
+                self.registration_doc_hash = document.content_hash
+            self.save()
+        if errors:
+            raise SchoolValidationError(
+                    "%d error(s) found in the registration document" %(
+                    len(errors),))
+        return True
+
     def drop_competitors_and_teams(self, force=False):
         SparringTeamRegistration.objects.filter(
                 tournament_division__tournament=self.tournament,
                 team__school=self.school_season_registration.school).delete()
         self.imported = False
+        self.registration_doc_hash = ''
         self.save()
 
 class SchoolTournamentRegistrationError(models.Model):
@@ -326,6 +561,11 @@ class SparringDivision(models.Model):
     tournaments = models.ManyToManyField('Tournament',
             through='TournamentSparringDivision')
 
+    SEX_NAMES = {
+        SexField.FEMALE: "Women's",
+        SexField.MALE: "Men's",
+    }
+
     class Meta:
         unique_together = (("sex", "skill_level"),)
 
@@ -338,9 +578,7 @@ class SparringDivision(models.Model):
         return slugify(str(self))
 
     def __str__(self):
-        if self.sex == SexField.FEMALE: sex_name = "Women's"
-        if self.sex == SexField.MALE: sex_name = "Men's"
-        return sex_name + " " + self.skill_level
+        return SparringDivision.SEX_NAMES[self.sex] + " " + self.skill_level
 
     def match_number_start_val(self):
         if self.skill_level == SparringDivisionLevelField.A_TEAM_VAL:
@@ -362,9 +600,29 @@ class TournamentSparringDivisionStatus():
         return "%d/%d matches completed" %(
                  self.num_matches_completed, self.num_matches,)
 
+    def to_json(self):
+        return {
+            'num_matches': self.num_matches,
+            'num_matches_completed': self.num_matches_completed,
+            'text': str(self),
+        }
+
 class TournamentSparringDivision(models.Model):
+    """A SparringDivision being contested at a Tournament.
+
+    Attributes:
+        num_matches     The number of SparringTeamMatches in this division
+        num_matches_completed
+                        The number of those SparringTeamMatches that have a
+                        winning_team
+    The match counts are maintained by SparringTeamMatch.save() and on
+    deletion of SparringTeamMatches; recount_matches() recomputes them from
+    scratch.
+    """
     tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE)
     division = models.ForeignKey(SparringDivision, on_delete=models.PROTECT)
+    num_matches = models.PositiveIntegerField(default=0)
+    num_matches_completed = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = (('tournament', 'division'),)
@@ -375,14 +633,43 @@ class TournamentSparringDivision(models.Model):
     def __repr__(self):
         return "%s (%s)" %(self.division, self.tournament)
 
+    @staticmethod
+    def annotate_status(query_set):
+        """Annotates the match counts of every TournamentSparringDivision in
+        query_set as computed from its SparringTeamMatches, in a single
+        query."""
+        return query_set.annotate(
+                match_count=Count('sparringteammatch'),
+                completed_match_count=Count('sparringteammatch',
+                        filter=Q(sparringteammatch__winning_team__isnull=False)))
+
+    @classmethod
+    def recount_matches(cls, query_set=None):
+        """Recomputes num_matches and num_matches_completed of the
+        TournamentSparringDivisions in query_set (all of them by default)."""
+        if query_set is None:
+            query_set = cls.objects.all()
+        for tournament_division in cls.annotate_status(query_set):
+            cls.objects.filter(pk=tournament_division.pk).update(
+                    num_matches=tournament_division.match_count,
+                    num_matches_completed=tournament_division.completed_match_count)
+
+    @staticmethod
+    def adjust_match_counts(tournament_division_id, num_matches=0,
+            num_matches_completed=0):
+        """Atomically adds the given deltas to the match counts of a
+        TournamentSparringDivision."""
+        if not (num_matches or num_matches_completed):
+            return
+        TournamentSparringDivision.objects.filter(
+                pk=tournament_division_id).update(
+                num_matches=F('num_matches') + num_matches,
+                num_matches_completed=F('num_matches_completed')
+                        + num_matches_completed)
+
     def status(self):
-        matches = SparringTeamMatch.objects.filter(division=self)
-        num_matches = num_matches_completed = 0
-        for match in matches:
-            num_matches += 1
-            num_matches_completed += bool(match.winning_team)
-        return TournamentSparringDivisionStatus(num_matches,
-                num_matches_completed)
+        return TournamentSparringDivisionStatus(self.num_matches,
+                self.num_matches_completed)
 
     def assign_slots_to_team_registrations(self):
         """
@@ -406,32 +693,33 @@ class TournamentSparringDivision(models.Model):
         return teams
 
     def create_matches_from_slots(self):
-        SparringTeamMatch.objects.filter(division=self).delete()
-        seeded_teams = SparringTeamRegistration.objects.filter(
-                tournament_division=self, seed__isnull=False)
-        seeds = {team.seed:team for team in seeded_teams}
-        start_val = self.division.match_number_start_val()
-        bracket = BracketGenerator(seeds, match_number_start_val=start_val)
-        for bracket_match in bracket:
-            match = SparringTeamMatch(division=self,
-                    number=bracket_match.number,
-                    round_num = bracket_match.round_num,
-                    round_slot = bracket_match.round_slot)
-
-            try:
-                match.blue_team = bracket_match.blue_team
-            except AttributeError:
-                pass
-            try:
-                bracket_match.red_team
-            except: pass
-            try:
-                match.red_team = bracket_match.red_team
-            except AttributeError:
-                pass
-
-            match.clean()
-            match.save()
+        with transaction.atomic():
+            SparringTeamMatch.objects.filter(division=self).delete()
+            seeded_teams = SparringTeamRegistration.objects.filter(
+                    tournament_division=self, seed__isnull=False)
+            seeds = {team.seed:team for team in seeded_teams}
+            start_val = self.division.match_number_start_val()
+            bracket = BracketGenerator(seeds, match_number_start_val=start_val)
+            for bracket_match in bracket:
+                match = SparringTeamMatch(division=self,
+                        number=bracket_match.number,
+                        round_num = bracket_match.round_num,
+                        round_slot = bracket_match.round_slot)
+
+                try:
+                    match.blue_team = bracket_match.blue_team
+                except AttributeError:
+                    pass
+                try:
+                    bracket_match.red_team
+                except: pass
+                try:
+                    match.red_team = bracket_match.red_team
+                except AttributeError:
+                    pass
+
+                match.clean()
+                match.save()
 
 class TournamentSparringDivisionBeltRanks(models.Model):
     belt_rank = BeltRankField()
@@ -560,6 +848,9 @@ class SparringTeamMatch(models.Model):
         ring_assignment_time
                         The time at which the ring was assigned
         winning_team    The winner of the SparringTeamMatch
+        version         Incremented every time the match is saved, so that
+                        concurrent changes can be detected (see
+                        update_matches())
     """
     division = models.ForeignKey(TournamentSparringDivision, on_delete=models.CASCADE)
     number = models.PositiveIntegerField()
@@ -578,6 +869,7 @@ class SparringTeamMatch(models.Model):
     in_holding = models.BooleanField(default=False)
     at_ring = models.BooleanField(default=False)
     competing = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = (
@@ -585,9 +877,296 @@ class SparringTeamMatch(models.Model):
                 ("division", "number",),
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so that save() can tell if the match was completed, and
+        # so that the ring the match was moved away from (and the schools of
+        # the teams removed from it) are notified
+        instance._loaded_winning_team_id = instance.__dict__.get(
+                'winning_team_id')
+        instance._loaded_ring_number = instance.__dict__.get('ring_number')
+        instance._loaded_blue_team_id = instance.__dict__.get('blue_team_id')
+        instance._loaded_red_team_id = instance.__dict__.get('red_team_id')
+        instance._loaded_version = instance.__dict__.get('version')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Saves the match. Raises MatchConflictError if the match was
+        changed by someone else since it was loaded (see
+        increment_version())."""
+        adding = self._state.adding
+        with transaction.atomic():
+            if not adding:
+                self.increment_version()
+                if kwargs.get('update_fields') is not None:
+                    kwargs['update_fields'] = set(kwargs['update_fields']) \
+                            | {'version'}
+            super().save(*args, **kwargs)
+            is_completed = self.winning_team_id is not None
+            if adding:
+                TournamentSparringDivision.adjust_match_counts(
+                        self.division_id, num_matches=1,
+                        num_matches_completed=int(is_completed))
+            else:
+                was_completed = getattr(self, '_loaded_winning_team_id',
+                        None) is not None
+                TournamentSparringDivision.adjust_match_counts(
+                        self.division_id,
+                        num_matches_completed=int(is_completed)
+                                - int(was_completed))
+        self._loaded_winning_team_id = self.winning_team_id
+        self._loaded_ring_number = self.ring_number
+        self._loaded_blue_team_id = self.blue_team_id
+        self._loaded_red_team_id = self.red_team_id
+        self._loaded_version = self.version
+
+    def increment_version(self):
+        """Increments the version of the match in the database, but only if
+        it is still the version the match was loaded with, and sets version
+        to the new value. Raises MatchConflictError otherwise.
+
+        The UPDATE locks the row until the end of the transaction, so the
+        rest of the match can be written without overwriting a concurrent
+        change (see conditional_bulk_update())."""
+        loaded_version = getattr(self, '_loaded_version', None)
+        if loaded_version is None:
+            loaded_version = self.version
+        num_updated = SparringTeamMatch.objects.filter(pk=self.pk,
+                version=loaded_version).update(version=F('version') + 1)
+        if not num_updated:
+            current_match = SparringTeamMatch.objects.select_related(
+                    'division').filter(pk=self.pk).first()
+            if current_match is not None:
+                raise MatchConflictError(SparringTeamMatch.conflict_message(
+                        [current_match]), [current_match])
+        self.version = loaded_version + 1
+
     def __str__(self):
         return "Match #" + str(self.number)
 
+    def team_ids(self):
+        return [team_id for team_id in (self.blue_team_id, self.red_team_id)
+                if team_id is not None]
+
+    def subscriber_team_ids(self):
+        """Returns the ids of the teams whose schools receive the updates of
+        this match: its teams and the teams it had when it was loaded."""
+        team_ids = self.team_ids()
+        for team_id in (getattr(self, '_loaded_blue_team_id', None),
+                getattr(self, '_loaded_red_team_id', None)):
+            if team_id is not None and team_id not in team_ids:
+                team_ids.append(team_id)
+        return team_ids
+
+    def subscription_keys(self, school_ids_by_team_id=None):
+        """Returns the keys of the subscriptions (see TournamentUpdate) which
+        receive the updates of this match: its division, its ring (and the
+        ring it was at when it was loaded) and the schools of its teams (and
+        of the teams it had when it was loaded).
+
+        school_ids_by_team_id maps the ids of SparringTeamRegistrations to
+        the ids of their schools; they are looked up if it is not given."""
+        keys = {TournamentUpdate.subscription_key('division',
+                self.division_id)}
+        for ring_number in (self.ring_number,
+                getattr(self, '_loaded_ring_number', None)):
+            if ring_number is not None:
+                keys.add(TournamentUpdate.subscription_key('ring',
+                        ring_number))
+        team_ids = self.subscriber_team_ids()
+        if school_ids_by_team_id is None and team_ids:
+            school_ids_by_team_id = dict(
+                    SparringTeamRegistration.objects.filter(
+                    pk__in=team_ids).values_list('pk', 'team__school'))
+        for team_id in team_ids:
+            school_id = school_ids_by_team_id.get(team_id)
+            if school_id is not None:
+                keys.add(TournamentUpdate.subscription_key('school',
+                        school_id))
+        return sorted(keys)
+
+    @staticmethod
+    def update_matches(patches):
+        """Applies patches, a list of (match id, {field attname: value},
+        version), in a single transaction and returns the matches which were
+        changed.
+
+        All of the matches are fetched in one query, the winning teams are
+        moved to the next round matches (see update_winning_team()) in
+        memory and every changed match is written with one conditional
+        UPDATE (see conditional_bulk_update()). As save() is not called, the
+        match counts of the divisions and the TournamentUpdates are recorded
+        here, so the whole change is broadcast as one message.
+
+        No rows are locked. Instead, MatchConflictError is raised if the
+        version of a patch (the version of the match the client saw, or None
+        to skip the check) is not the current one, or if any of the matches
+        is changed by someone else before the UPDATE.
+        """
+        with transaction.atomic():
+            match_ids = [match_id for match_id, fields, version in patches]
+            matches_by_id = SparringTeamMatch.objects.select_related(
+                    'division').in_bulk(match_ids)
+            matches_by_slot = {}
+            for match in matches_by_id.values():
+                matches_by_slot[match.bracket_slot()] = match
+            changed_matches = OrderedDict()
+            changed_fields = set()
+            conflicting_matches = []
+            for match_id, fields, version in patches:
+                match = matches_by_id.get(match_id)
+                if match is None:
+                    raise SparringTeamMatch.DoesNotExist(
+                            "Match %s does not exist" %(match_id,))
+                if version is not None and version != match.version:
+                    conflicting_matches.append(match)
+                    continue
+                for field_attname, value in fields.items():
+                    setattr(match, field_attname, value)
+                    changed_fields.add(
+                            match._meta.get_field(field_attname).name)
+                if match.winning_team_id not in (None, match.blue_team_id,
+                        match.red_team_id):
+                    raise ValueError("Team %s is not in match %s" %(
+                            match.winning_team_id, match.number))
+                changed_matches[match.pk] = match
+            if conflicting_matches:
+                raise MatchConflictError(
+                        SparringTeamMatch.conflict_message(
+                        conflicting_matches), conflicting_matches)
+
+            # move the winning teams forward, one round at a time
+            matches_to_clean = list(changed_matches.values())
+            while matches_to_clean:
+                next_slots = {match.next_round_bracket_slot()
+                        for match in matches_to_clean}
+                SparringTeamMatch.fetch_bracket_slots(
+                        next_slots - set(matches_by_slot), matches_by_slot)
+                next_matches_to_clean = []
+                for match in matches_to_clean:
+                    parent_match = match.apply_winning_team(
+                            matches_by_slot.get(match.next_round_bracket_slot()))
+                    if parent_match is not None:
+                        changed_matches[parent_match.pk] = parent_match
+                        changed_fields.update(('blue_team', 'red_team'))
+                        next_matches_to_clean.append(parent_match)
+                matches_to_clean = next_matches_to_clean
+
+            changed_matches = list(changed_matches.values())
+            SparringTeamMatch.conditional_bulk_update(changed_matches,
+                    sorted(changed_fields))
+            SparringTeamMatch.record_bulk_update(changed_matches)
+        return changed_matches
+
+    @staticmethod
+    def conditional_bulk_update(matches, field_names):
+        """Writes field_names of matches, and increments their versions, in
+        a single UPDATE which only matches rows which still have the version
+        they were loaded with. Raises MatchConflictError (in which case
+        nothing is written) if any of them was changed in the meantime."""
+        if not matches:
+            return
+        opts = SparringTeamMatch._meta
+        versions_query = Q()
+        for match in matches:
+            versions_query |= Q(pk=match.pk, version=match._loaded_version)
+        updates = {}
+        for field_name in field_names:
+            field = opts.get_field(field_name)
+            updates[field.attname] = Case(*[When(pk=match.pk,
+                    then=Value(getattr(match, field.attname),
+                            output_field=field))
+                    for match in matches], output_field=field)
+        updates['version'] = F('version') + 1
+        num_updated = SparringTeamMatch.objects.filter(versions_query).update(
+                **updates)
+        if num_updated != len(matches):
+            current_matches = SparringTeamMatch.objects.select_related(
+                    'division').in_bulk([match.pk for match in matches])
+            conflicting_matches = [current_matches[match.pk]
+                    for match in matches if match.pk in current_matches
+                    and current_matches[match.pk].version
+                            != match._loaded_version]
+            raise MatchConflictError(SparringTeamMatch.conflict_message(
+                    conflicting_matches), conflicting_matches)
+        for match in matches:
+            match.version = match._loaded_version + 1
+
+    @staticmethod
+    def conflict_message(matches):
+        return "Match %s was changed by someone else. Please try again." %(
+                ", ".join("#%d" %(match.number,) for match in matches),)
+
+    def bracket_slot(self):
+        return (self.division_id, self.round_num, self.round_slot)
+
+    def next_round_bracket_slot(self):
+        return (self.division_id, self.round_num - 1, self.round_slot // 2)
+
+    @staticmethod
+    def fetch_bracket_slots(bracket_slots, matches_by_slot):
+        """Fetches the matches in bracket_slots into matches_by_slot."""
+        if not bracket_slots:
+            return
+        slots_query = Q()
+        for division_id, round_num, round_slot in bracket_slots:
+            slots_query |= Q(division_id=division_id, round_num=round_num,
+                    round_slot=round_slot)
+        for match in SparringTeamMatch.objects.select_related(
+                'division').filter(slots_query):
+            matches_by_slot[match.bracket_slot()] = match
+
+    def apply_winning_team(self, parent_match):
+        """Like update_winning_team(), but only changes parent_match (the
+        next round match) in memory. Returns parent_match if it was
+        changed."""
+        if parent_match is None:
+            return None
+        if parent_match.winning_team_id is not None:
+            raise IntegrityError("Unable to update match - match #%d's winning team must be removed first" %(parent_match.number))
+        if self.round_slot % 2:
+            if parent_match.red_team_id == self.winning_team_id:
+                return None
+            parent_match.red_team_id = self.winning_team_id
+        else:
+            if parent_match.blue_team_id == self.winning_team_id:
+                return None
+            parent_match.blue_team_id = self.winning_team_id
+        return parent_match
+
+    @staticmethod
+    def record_bulk_update(matches):
+        """Does what save() and the post_save receivers do for matches
+        which were written with bulk_update()."""
+        completed_deltas = defaultdict(int)
+        for match in matches:
+            completed_deltas[match.division_id] += \
+                    int(match.winning_team_id is not None) \
+                    - int(match._loaded_winning_team_id is not None)
+        for division_id, completed_delta in completed_deltas.items():
+            TournamentSparringDivision.adjust_match_counts(division_id,
+                    num_matches_completed=completed_delta)
+
+        team_ids = {team_id for match in matches
+                for team_id in match.subscriber_team_ids()}
+        school_ids_by_team_id = dict(SparringTeamRegistration.objects.filter(
+                pk__in=team_ids).values_list('pk', 'team__school'))
+        updates_by_tournament = OrderedDict()
+        for match in matches:
+            updates_by_tournament.setdefault(match.division.tournament_id,
+                    []).append(TournamentUpdate.for_team_match(match,
+                    TournamentUpdate.UPDATE, school_ids_by_team_id))
+        for tournament_id, tournament_updates in updates_by_tournament.items():
+            TournamentUpdate.record_changes(tournament_id, tournament_updates)
+
+        for match in matches:
+            match._loaded_winning_team_id = match.winning_team_id
+            match._loaded_ring_number = match.ring_number
+            match._loaded_blue_team_id = match.blue_team_id
+            match._loaded_red_team_id = match.red_team_id
+            match._loaded_version = match.version
+
     def status(self):
         if self.winning_team:
                 return "Complete"
@@ -655,7 +1234,388 @@ class SparringTeamMatch(models.Model):
     def clean(self, *args, **kwargs):
         self.update_winning_team()
 
+@receiver(post_delete, sender=SparringTeamMatch,
+        dispatch_uid="update_division_match_counts")
+def update_division_match_counts(sender, instance, **kwargs):
+    TournamentSparringDivision.adjust_match_counts(instance.division_id,
+            num_matches=-1,
+            num_matches_completed=-int(instance.winning_team_id is not None))
+
+# Sent after every commit which recorded TournamentUpdates, once per
+# tournament with the committed updates in sequence order, so that they can
+# be broadcast to the clients of the tournament
+tournament_updated = Signal(providing_args=['tournament_id',
+        'tournament_updates'])
+
+class TournamentUpdate(models.Model):
+    """A change to the data of the snapshot of a tournament, as broadcast to
+    the match update websockets.
+
+    sequence is the snapshot_version of the tournament right after the
+    change. The last HISTORY_LENGTH updates of every tournament are kept, so
+    that a client which missed some broadcasts can fetch only the updates
+    after the last sequence it has seen (see updates_since()). Changes
+    which are not broadcast (e.g. team registrations) bump the
+    snapshot_version without an update, which makes clients fall back to
+    a full snapshot.
+
+    Updates are written in the same transaction as the change, so the table
+    also serves as an outbox: updates are broadcast with publish() and then
+    marked as published, either right after the commit by the process which
+    made the change (if settings.PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT is
+    set) or by the publish_tournament_updates command.
+
+    Every update is a change to one row of a table of the compact snapshot
+    (see tmdb.snapshot). message_content is stored already encoded as JSON:
+    a list holding the new row for an update, or its pk for a delete. Every
+    message is built from these without decoding them again.
+    """
+    HISTORY_LENGTH = 1000
+    UPDATE = 'update'
+    DELETE = 'delete'
+    BATCH = 'batch'
+
+    # ids of the updates recorded by this thread which have not been
+    # broadcast yet, by tournament id
+    _pending = threading.local()
+
+    # Updates may be recorded while the tournament itself is being deleted,
+    # so there is no database constraint; they are removed by
+    # delete_tournament_updates() instead.
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE,
+            db_constraint=False)
+    sequence = models.PositiveIntegerField()
+    message_type = models.CharField(max_length=16)
+    # the name of the table of the compact snapshot, e.g.
+    # "tmdb_sparringteammatch", and the pk of the row
+    model = models.CharField(max_length=64)
+    object_id = models.PositiveIntegerField()
+    message_content = models.TextField()
+    # space separated keys of the subscriptions which receive the update
+    subscription_keys = models.TextField(default='')
+    published = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        unique_together = (('tournament', 'sequence'),)
+
+    # Clients may subscribe to the updates of some rings, divisions (by
+    # TournamentSparringDivision id) or schools instead of the whole
+    # tournament. A subscription is identified by a key such as "ring-3".
+    SUBSCRIPTION_TYPES = ('ring', 'division', 'school',)
+
+    @staticmethod
+    def subscription_key(subscription_type, subscription_id):
+        return "%s-%d" %(subscription_type, subscription_id)
+
+    @staticmethod
+    def parse_subscription_keys(params):
+        """Returns the subscription keys given by params, a mapping of query
+        parameter names to lists of values. Invalid values are ignored."""
+        keys = []
+        for subscription_type in TournamentUpdate.SUBSCRIPTION_TYPES:
+            for value in params.get(subscription_type, []):
+                try:
+                    keys.append(TournamentUpdate.subscription_key(
+                            subscription_type, int(value)))
+                except ValueError:
+                    continue
+        return keys
+
+    def get_subscription_keys(self):
+        return self.subscription_keys.split()
+
+    def message_json(self):
+        """Returns the websocket message of the update, e.g.
+
+            {"message_type": "update", "model": "tmdb_sparringteammatch",
+             "seq": 12, "message_content": [[3, 5, null, ...]]}
+        """
+        return '{"message_type":%s,"model":%s,"seq":%d,"message_content":%s}' %(
+                json.dumps(self.message_type), json.dumps(self.model),
+                self.sequence, self.message_content)
+
+    def message_msgpack(self):
+        """Returns message_json() encoded as MessagePack. The encoding is
+        kept, so it is only done once per instance."""
+        if getattr(self, '_message_msgpack', None) is None:
+            from tmdb.snapshot import packb
+            self._message_msgpack = packb(OrderedDict([
+                ('message_type', self.message_type),
+                ('model', self.model),
+                ('seq', self.sequence),
+                ('message_content', json.loads(self.message_content)),
+            ]))
+        return self._message_msgpack
+
+    @staticmethod
+    def for_team_match(match, message_type, school_ids_by_team_id=None):
+        """Returns the (unsaved) update or delete of a SparringTeamMatch."""
+        from tmdb.snapshot import compact_row
+        if message_type == TournamentUpdate.UPDATE:
+            message_content = [compact_row('team_match', match)]
+        else:
+            message_content = [match.pk]
+        return TournamentUpdate(message_type=message_type,
+                model='tmdb_sparringteammatch', object_id=match.pk,
+                message_content=json.dumps(message_content,
+                        cls=DjangoJSONEncoder, separators=(',', ':')),
+                subscription_keys=" ".join(
+                        match.subscription_keys(school_ids_by_team_id)))
+
+    @staticmethod
+    def record(tournament_id, tournament_update):
+        """Bumps the snapshot_version of a tournament and saves
+        tournament_update with the new version as its sequence."""
+        tournament_updates = TournamentUpdate.record_changes(tournament_id,
+                [tournament_update])
+        return tournament_updates[0] if tournament_updates else None
+
+    @staticmethod
+    def record_changes(tournament_id, tournament_updates):
+        """Saves tournament_updates with consecutive sequences (see
+        record()) and returns them."""
+        with transaction.atomic():
+            last_sequence = Tournament.bump_snapshot_version(tournament_id,
+                    increment=len(tournament_updates))
+            if last_sequence is None:
+                return []
+            first_sequence = last_sequence - len(tournament_updates) + 1
+            max_sequence = TournamentUpdate.objects.filter(
+                    tournament_id=tournament_id).aggregate(
+                    Max('sequence'))['sequence__max']
+            if max_sequence is not None and first_sequence <= max_sequence:
+                # The snapshot_version was set back below the updates
+                # already recorded; move it past them instead of failing on
+                # the unique sequence of every later update.
+                last_sequence = Tournament.bump_snapshot_version(
+                        tournament_id,
+                        increment=max_sequence - first_sequence + 1)
+                first_sequence = last_sequence - len(tournament_updates) + 1
+            for update_num, tournament_update in enumerate(
+                    tournament_updates):
+                tournament_update.tournament_id = tournament_id
+                tournament_update.sequence = first_sequence + update_num
+            if len(tournament_updates) == 1:
+                # save() sets the pk on every database backend
+                tournament_updates[0].save()
+            else:
+                tournament_updates = TournamentUpdate.objects.bulk_create(
+                        tournament_updates)
+                if tournament_updates[0].pk is None:
+                    tournament_updates = list(TournamentUpdate.objects.filter(
+                            tournament_id=tournament_id,
+                            sequence__gte=first_sequence,
+                            sequence__lte=last_sequence).order_by('sequence'))
+            TournamentUpdate.objects.filter(tournament_id=tournament_id,
+                    sequence__lte=last_sequence - TournamentUpdate.HISTORY_LENGTH,
+                    published=True).delete()
+        if not getattr(settings, 'PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT', True):
+            return tournament_updates
+        pending = getattr(TournamentUpdate._pending, 'update_ids', None)
+        if pending is None:
+            pending = TournamentUpdate._pending.update_ids = {}
+        pending.setdefault(tournament_id, []).extend(
+                tournament_update.pk for tournament_update in tournament_updates)
+        transaction.on_commit(TournamentUpdate.send_pending_updates)
+        return tournament_updates
+
+    @staticmethod
+    def send_pending_updates():
+        """Sends tournament_updated for the updates recorded by this thread
+        which have been committed.
+
+        This runs when the transaction in which the updates were recorded
+        commits, so all of the changes made by a transaction are sent
+        together. The updates are read back from the database, so changes
+        which were rolled back (with a savepoint, or by an earlier
+        transaction of this thread) are never sent.
+
+        The changes have been committed by then, so a failure to send is
+        only logged. The updates stay unpublished and are sent along with
+        the next updates of the tournament (earlier unpublished updates are
+        included), or by the publish_tournament_updates command.
+        """
+        pending = getattr(TournamentUpdate._pending, 'update_ids', None)
+        if not pending:
+            return
+        TournamentUpdate._pending.update_ids = {}
+        for tournament_id, update_ids in pending.items():
+            tournament_updates = list(TournamentUpdate.objects.filter(
+                    Q(pk__in=update_ids) | Q(pk__lt=min(update_ids)),
+                    tournament_id=tournament_id, published=False).order_by(
+                    'sequence'))
+            if not tournament_updates:
+                continue
+            try:
+                TournamentUpdate.publish(tournament_id, tournament_updates)
+            except Exception:
+                logger.exception("Unable to publish the updates of tournament %d",
+                        tournament_id)
+
+    @staticmethod
+    def publish(tournament_id, tournament_updates):
+        """Sends tournament_updated for tournament_updates (in sequence order)
+        and marks them as published.
+
+        If sending fails, the updates stay unpublished and are sent again by
+        the next publish_pending(), so every update is delivered at least
+        once (clients drop the ones they already have by sequence)."""
+        tournament_updated.send(sender=TournamentUpdate,
+                tournament_id=tournament_id,
+                tournament_updates=tournament_updates)
+        TournamentUpdate.objects.filter(pk__in=[tournament_update.pk
+                for tournament_update in tournament_updates]).update(
+                published=True)
+
+    @staticmethod
+    def publish_pending(batch_size=500):
+        """Publishes the oldest batch_size unpublished updates, grouped by
+        tournament. Returns the number of updates published."""
+        tournament_updates = list(TournamentUpdate.objects.filter(
+                published=False).order_by('pk')[:batch_size])
+        updates_by_tournament = OrderedDict()
+        for tournament_update in tournament_updates:
+            updates_by_tournament.setdefault(tournament_update.tournament_id,
+                    []).append(tournament_update)
+        for tournament_id, updates in updates_by_tournament.items():
+            updates.sort(key=lambda tournament_update: tournament_update.sequence)
+            TournamentUpdate.publish(tournament_id, updates)
+        return len(tournament_updates)
+
+    @staticmethod
+    def batch_message_json(tournament_updates):
+        """Returns a single message for tournament_updates, which must be in
+        sequence order.
+
+        Only the last update of every row is kept. The message covers the
+        sequences from first_seq to seq; its message_content is a list of
+        update and delete messages with their own sequences, so that clients
+        which receive batches of several subscriptions out of order can
+        tell which change of a row is the latest.
+        """
+        return '{"message_type":"%s","first_seq":%d,"seq":%d,"message_content":[%s]}' %(
+                TournamentUpdate.BATCH, tournament_updates[0].sequence,
+                tournament_updates[-1].sequence,
+                ",".join(tournament_update.message_json()
+                        for tournament_update in TournamentUpdate.latest_updates(
+                                tournament_updates)))
+
+    @staticmethod
+    def batch_message_msgpack(tournament_updates):
+        """Returns batch_message_json() encoded as MessagePack.
+
+        The message is joined from the encodings of the updates (see
+        message_msgpack()), so updates which are sent in the batches of
+        several subscriptions are only encoded once."""
+        from tmdb.snapshot import packb, packb_array_header, packb_map_header
+        latest_updates = TournamentUpdate.latest_updates(tournament_updates)
+        return b''.join([packb_map_header(4),
+                packb('message_type'), packb(TournamentUpdate.BATCH),
+                packb('first_seq'), packb(tournament_updates[0].sequence),
+                packb('seq'), packb(tournament_updates[-1].sequence),
+                packb('message_content'),
+                packb_array_header(len(latest_updates))]
+                + [tournament_update.message_msgpack()
+                        for tournament_update in latest_updates])
+
+    @staticmethod
+    def latest_updates(tournament_updates):
+        """Returns the last of tournament_updates for every row, in the order
+        of those updates."""
+        latest_updates = OrderedDict()
+        for tournament_update in tournament_updates:
+            row_key = (tournament_update.model, tournament_update.object_id)
+            latest_updates.pop(row_key, None)
+            latest_updates[row_key] = tournament_update
+        return list(latest_updates.values())
+
+    @staticmethod
+    def updates_since(tournament, sequence, subscription_keys=None):
+        """Returns the updates of tournament after sequence in order, or None
+        if any of them is no longer kept (or was never recorded).
+
+        If subscription_keys are given, only the updates for any of those
+        subscriptions are returned."""
+        if sequence > tournament.snapshot_version:
+            return None
+        updates = list(TournamentUpdate.objects.filter(tournament=tournament,
+                sequence__gt=sequence,
+                sequence__lte=tournament.snapshot_version).order_by(
+                'sequence'))
+        if len(updates) != tournament.snapshot_version - sequence:
+            return None
+        if subscription_keys:
+            subscription_keys = set(subscription_keys)
+            updates = [update for update in updates
+                    if subscription_keys.intersection(
+                            update.get_subscription_keys())]
+        return updates
+
+@receiver(post_save, sender=SparringTeamMatch,
+        dispatch_uid="record_team_match_update")
+def record_team_match_update(sender, instance, **kwargs):
+    TournamentUpdate.record(instance.division.tournament_id,
+            TournamentUpdate.for_team_match(instance,
+                    TournamentUpdate.UPDATE))
+
+@receiver(post_delete, sender=SparringTeamMatch,
+        dispatch_uid="record_team_match_delete")
+def record_team_match_delete(sender, instance, **kwargs):
+    TournamentUpdate.record(instance.division.tournament_id,
+            TournamentUpdate.for_team_match(instance,
+                    TournamentUpdate.DELETE))
+
+@receiver(post_delete, sender=Tournament,
+        dispatch_uid="delete_tournament_updates")
+def delete_tournament_updates(sender, instance, **kwargs):
+    TournamentUpdate.objects.filter(tournament_id=instance.pk).delete()
+
+@receiver([post_save, post_delete], sender=SparringTeamRegistration,
+        dispatch_uid="bump_team_registration_snapshot_version")
+def bump_team_registration_snapshot_version(sender, instance, **kwargs):
+    Tournament.bump_snapshot_version(
+            instance.tournament_division.tournament_id)
+
+# The snapshot (see tmdb.snapshot) also holds the tournament itself, its
+# divisions, the registrations of its schools and the schools and teams
+# which are registered, so changes to any of those bump the snapshot_version
+# of every tournament the changed row belongs to.
+
+@receiver(post_save, sender=Tournament,
+        dispatch_uid="bump_tournament_snapshot_version")
+def bump_tournament_snapshot_version(sender, instance, created, **kwargs):
+    if not created:
+        Tournament.bump_snapshot_version(instance.pk)
+
+@receiver([post_save, post_delete], sender=TournamentSparringDivision,
+        dispatch_uid="bump_tournament_division_snapshot_version")
+@receiver([post_save, post_delete], sender=SchoolTournamentRegistration,
+        dispatch_uid="bump_school_registration_snapshot_version")
+def bump_tournament_row_snapshot_version(sender, instance, **kwargs):
+    Tournament.bump_snapshot_version(instance.tournament_id)
+
+@receiver([post_save, post_delete], sender=SchoolSeasonRegistration,
+        dispatch_uid="bump_school_season_registration_snapshot_version")
+def bump_school_season_registration_snapshot_version(sender, instance,
+        **kwargs):
+    Tournament.bump_snapshot_versions(Tournament.objects.filter(
+            schooltournamentregistration__school_season_registration=instance))
+
+@receiver([post_save, post_delete], sender=School,
+        dispatch_uid="bump_school_snapshot_version")
+def bump_school_snapshot_version(sender, instance, **kwargs):
+    Tournament.bump_snapshot_versions(Tournament.objects.filter(
+            Q(schooltournamentregistration__school_season_registration__school=instance)
+            | Q(tournamentsparringdivision__sparringteamregistration__team__school=instance)))
+
+@receiver([post_save, post_delete], sender=SparringTeam,
+        dispatch_uid="bump_team_snapshot_version")
+def bump_team_snapshot_version(sender, instance, **kwargs):
+    Tournament.bump_snapshot_versions(Tournament.objects.filter(
+            tournamentsparringdivision__sparringteamregistration__team=instance))
+
 class ConfigurationSetting(models.Model):
     key = models.TextField(unique=True)
     value = models.TextField()
     REGISTRATION_CREDENTIALS = 'registration_credentials'
+    REGISTRATION_DIRECTORY = 'registration_directory'
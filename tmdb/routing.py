@@ -4,4 +4,9 @@ from . import consumers
 
 websocket_urlpatterns = [
     url(r'ws/tournaments/(?P<tournament_slug>[a-z0-9_-]+)/sparring_team_match_updates/*', consumers.SparringTeamMatchConsumer),
+    url(r'ws/tournaments/(?P<tournament_slug>[a-z0-9_-]+)/spectate/*', consumers.SpectatorConsumer),
+]
+
+http_urlpatterns = [
+    url(r'sse/tournaments/(?P<tournament_slug>[a-z0-9_-]+)/match_updates/*', consumers.MatchUpdateEventsConsumer),
 ]
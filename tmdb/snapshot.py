@@ -0,0 +1,317 @@
+import json
+import time
+
+import msgpack
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from tmdb import models
+
+json_fields = {
+    'tournament': ('id', 'location', 'date',),
+    'division': ('id', 'sex', 'skill_level',),
+    'school': ('id', 'name',),
+    'team': ('id', 'division', 'school', 'number',),
+    'tournament_division': ('id', 'division', 'tournament',),
+    'school_tournament_registration': ('id', 'school_season_registration',
+                    'tournament',),
+    'school_season_registration': ('id', 'school',),
+    'team_registration': ('id', 'lightweight', 'middleweight', 'heavyweight',
+                    'alternate1', 'alternate2', 'team', 'tournament_division',
+                    'points', 'seed',),
+    'team_match': ('id', 'blue_team', 'red_team', 'winning_team', 'division',
+                    'in_holding', 'at_ring', 'number', 'ring_assignment_time',
+                    'ring_number', 'round_num', 'round_slot', 'competing',
+                    'version',),
+}
+
+def snapshot_querysets(tournament):
+    """Returns (json_fields key, model label, queryset) for every kind of
+    row in the snapshot of tournament.
+
+    Only rows reachable from tournament are included, so the size of the
+    snapshot does not grow with the number of past seasons and tournaments.
+    """
+    team_registrations = models.SparringTeamRegistration.objects.filter(
+            tournament_division__tournament=tournament)
+    school_registrations = models.SchoolTournamentRegistration.objects.filter(
+            tournament=tournament)
+    team_school_ids = models.SparringTeam.objects.filter(
+            sparringteamregistration__tournament_division__tournament=tournament
+            ).values('school')
+    registered_school_ids = models.SchoolSeasonRegistration.objects.filter(
+            schooltournamentregistration__tournament=tournament
+            ).values('school')
+    return [
+        ('tournament', 'tmdb.tournament',
+                models.Tournament.objects.filter(pk=tournament.pk)),
+        ('division', 'tmdb.sparringdivision',
+                models.SparringDivision.objects.filter(
+                        tournamentsparringdivision__tournament=tournament)),
+        ('school', 'tmdb.school',
+                models.School.objects.filter(Q(pk__in=team_school_ids)
+                        | Q(pk__in=registered_school_ids))),
+        ('team', 'tmdb.sparringteam',
+                models.SparringTeam.objects.filter(
+                        sparringteamregistration__tournament_division__tournament=tournament
+                        ).distinct()),
+        ('tournament_division', 'tmdb.tournamentsparringdivision',
+                models.TournamentSparringDivision.objects.filter(
+                        tournament=tournament)),
+        ('school_tournament_registration',
+                'tmdb.schooltournamentregistration', school_registrations),
+        ('school_season_registration', 'tmdb.schoolseasonregistration',
+                models.SchoolSeasonRegistration.objects.filter(
+                        schooltournamentregistration__tournament=tournament)),
+        ('team_registration', 'tmdb.sparringteamregistration',
+                team_registrations),
+        ('team_match', 'tmdb.sparringteammatch',
+                models.SparringTeamMatch.objects.filter(
+                        division__tournament=tournament)),
+    ]
+
+def _iterate(query_set, chunk_size=None):
+    if chunk_size is None:
+        return query_set
+    return query_set.iterator(chunk_size=chunk_size)
+
+def iter_tournament_snapshot(tournament, chunk_size=None):
+    """Yields the rows of the snapshot of tournament in the format of
+    django.core.serializers' python serializer (model, pk and fields).
+
+    If chunk_size is given, the querysets are walked with iterator() so that
+    only chunk_size rows are held in memory at a time."""
+    for fields_key, model_label, query_set in snapshot_querysets(tournament):
+        fields = json_fields[fields_key]
+        for row in _iterate(query_set.values(*fields), chunk_size):
+            pk = row.pop('id')
+            yield {'model': model_label, 'pk': pk, 'fields': row}
+
+def build_tournament_snapshot(tournament):
+    """Returns the rows of the snapshot of tournament (see
+    iter_tournament_snapshot())."""
+    return list(iter_tournament_snapshot(tournament))
+
+COMPACT_FORMAT = 'tmdb-compact'
+COMPACT_FORMAT_VERSION = 1
+
+# the team_registration columns of the compact format, which replace the
+# team with the school and display string of the team
+compact_team_registration_columns = tuple(field
+        for field in json_fields['team_registration'] if field != 'team') \
+        + ('school', 'display',)
+
+def team_registration_display(school_name, sex, skill_level, team_number,
+        lightweight, middleweight, heavyweight):
+    """Returns the label of a team registration used by the dashboard (see
+    render_team_registration() in match_websocket.js)."""
+    division_str = "%s %s" %(models.SparringDivision.SEX_NAMES.get(
+            sex, "Unknown"), skill_level)
+    team_display = "%s %s%d" %(school_name, division_str, team_number)
+    composition = ("L" if lightweight else "") \
+            + ("M" if middleweight else "") \
+            + ("H" if heavyweight else "")
+    if composition:
+        team_display = "%s (%s)" %(team_display, composition)
+    return team_display
+
+def _compact_value(value):
+    if value is True or value is False:
+        return int(value)
+    return value
+
+def _compact_rows(rows):
+    for row in rows:
+        yield [_compact_value(value) for value in row]
+
+def compact_row(fields_key, instance):
+    """Returns instance as a row of its table in the compact snapshot."""
+    opts = instance._meta
+    return [_compact_value(getattr(instance, opts.get_field(field).attname))
+            for field in json_fields[fields_key]]
+
+def _compact_team_registration_rows(query_set, chunk_size=None):
+    fields = compact_team_registration_columns[:-2]
+    weight_class_indexes = [fields.index(weight_class) for weight_class
+            in ('lightweight', 'middleweight', 'heavyweight')]
+    rows = query_set.values_list(*fields, 'team__school',
+            'team__school__name', 'team__division__sex',
+            'team__division__skill_level', 'team__number')
+    num_fields = len(fields)
+    for row in _iterate(rows, chunk_size):
+        (school_id, school_name, sex, skill_level,
+                team_number) = row[num_fields:]
+        display = team_registration_display(school_name, sex, skill_level,
+                team_number, *(row[i] for i in weight_class_indexes))
+        yield row[:num_fields] + (school_id, display)
+
+def iter_compact_tables(tournament, chunk_size=None):
+    """Yields (table name, columns, rows) for every table of the compact
+    snapshot of tournament, where rows is an iterator (see
+    iter_tournament_snapshot() for chunk_size)."""
+    for fields_key, model_label, query_set in snapshot_querysets(tournament):
+        if fields_key == 'team':
+            continue
+        if fields_key == 'team_registration':
+            columns = compact_team_registration_columns
+            rows = _compact_team_registration_rows(query_set, chunk_size)
+        else:
+            columns = json_fields[fields_key]
+            rows = _iterate(query_set.values_list(*columns), chunk_size)
+        yield model_label.replace('.', '_'), columns, _compact_rows(rows)
+
+def build_compact_tournament_snapshot(tournament):
+    """Returns the snapshot of tournament in the compact format.
+
+    Each model is a table of column names and rows, where every row is a
+    list of values in column order with the pk first and booleans encoded
+    as 0 or 1:
+
+        {"format": "tmdb-compact", "version": 1, "seq": 12,
+         "tables": {"tmdb_school": {"columns": ["id", "name"],
+                                    "rows": [[1, "..."], ...]},
+                    ...}}
+
+    seq is the snapshot_version of the tournament the snapshot was built
+    for (see tmdb.models.TournamentUpdate).
+
+    Team registration rows carry the id of the school and the display
+    string of the team instead of the team, so the SparringTeam table is
+    left out.
+    """
+    tables = {}
+    for table_name, columns, rows in iter_compact_tables(tournament):
+        tables[table_name] = {
+            'columns': columns,
+            'rows': list(rows),
+        }
+    return {
+        'format': COMPACT_FORMAT,
+        'version': COMPACT_FORMAT_VERSION,
+        'seq': tournament.snapshot_version,
+        'tables': tables,
+    }
+
+SNAPSHOT_FORMATS = ('list', 'compact',)
+SNAPSHOT_CACHE_TIMEOUT = 60 * 60
+SNAPSHOT_BUILD_LOCK_TIMEOUT = 30
+SNAPSHOT_BUILD_WAIT = 5
+
+def build_snapshot_json(tournament, snapshot_format):
+    if snapshot_format == 'compact':
+        return json.dumps(build_compact_tournament_snapshot(tournament),
+                cls=DjangoJSONEncoder, separators=(',', ':'))
+    return json.dumps(build_tournament_snapshot(tournament),
+            cls=DjangoJSONEncoder)
+
+def packb(obj):
+    """Encodes obj as MessagePack, with dates and times encoded as strings
+    like in the JSON snapshots."""
+    return msgpack.packb(obj, use_bin_type=True,
+            default=DjangoJSONEncoder().default)
+
+_packer = msgpack.Packer(use_bin_type=True)
+
+def packb_array_header(length):
+    """Returns the MessagePack header of an array of length items, which
+    are encoded separately and appended to it."""
+    return _packer.pack_array_header(length)
+
+def packb_map_header(length):
+    """Returns the MessagePack header of a map of length key-value pairs."""
+    return _packer.pack_map_header(length)
+
+def build_snapshot_msgpack(tournament):
+    return packb(build_compact_tournament_snapshot(tournament))
+
+SNAPSHOT_STREAM_CHUNK_SIZE = 2000
+
+def _encode_rows(encoder, rows, batch_size):
+    """Yields the JSON encoding of rows, separated like the items of a list,
+    batch_size rows at a time."""
+    separator = ''
+    batch = []
+    for row in rows:
+        batch.append(encoder.encode(row))
+        if len(batch) == batch_size:
+            yield separator + encoder.item_separator.join(batch)
+            separator = encoder.item_separator
+            batch = []
+    if batch:
+        yield separator + encoder.item_separator.join(batch)
+
+def stream_snapshot_json(tournament, snapshot_format,
+        chunk_size=SNAPSHOT_STREAM_CHUNK_SIZE):
+    """Yields the same JSON as build_snapshot_json() in pieces.
+
+    The rows are read chunk_size at a time and encoded as they are read, so
+    the memory used does not depend on the size of the tournament.
+    """
+    if snapshot_format == 'compact':
+        encoder = DjangoJSONEncoder(separators=(',', ':'))
+        yield '{"format":%s,"version":%d,"seq":%d,"tables":{' %(
+                encoder.encode(COMPACT_FORMAT), COMPACT_FORMAT_VERSION,
+                tournament.snapshot_version)
+        separator = ''
+        for table_name, columns, rows in iter_compact_tables(tournament,
+                chunk_size=chunk_size):
+            yield '%s%s:{"columns":%s,"rows":[' %(separator,
+                    encoder.encode(table_name), encoder.encode(columns))
+            yield from _encode_rows(encoder, rows, chunk_size)
+            yield ']}'
+            separator = ','
+        yield '}}'
+        return
+    encoder = DjangoJSONEncoder()
+    yield '['
+    yield from _encode_rows(encoder,
+            iter_tournament_snapshot(tournament, chunk_size=chunk_size),
+            chunk_size)
+    yield ']'
+
+def snapshot_cache_key(tournament_slug, snapshot_version, snapshot_format):
+    return "tmdb-snapshot:%s:%d:%s" %(tournament_slug, snapshot_version,
+            snapshot_format)
+
+def get_snapshot_json(tournament, snapshot_format):
+    """Returns the snapshot of tournament encoded as JSON.
+
+    Snapshots are cached per tournament.snapshot_version, so they are only
+    rebuilt after the tournament has changed. When many clients request an
+    uncached snapshot at the same time, one of them builds it while the
+    others wait (for up to SNAPSHOT_BUILD_WAIT seconds) for it to appear in
+    the cache.
+    """
+    return _get_cached_snapshot(tournament, snapshot_format,
+            lambda: build_snapshot_json(tournament, snapshot_format))
+
+def get_snapshot_msgpack(tournament):
+    """Returns the compact snapshot of tournament encoded as MessagePack
+    (cached like get_snapshot_json())."""
+    return _get_cached_snapshot(tournament, 'msgpack',
+            lambda: build_snapshot_msgpack(tournament))
+
+def _get_cached_snapshot(tournament, snapshot_format, build_snapshot):
+    cache_key = snapshot_cache_key(tournament.slug,
+            tournament.snapshot_version, snapshot_format)
+    snapshot_data = cache.get(cache_key)
+    if snapshot_data is not None:
+        return snapshot_data
+
+    lock_key = cache_key + ':lock'
+    if not cache.add(lock_key, True, SNAPSHOT_BUILD_LOCK_TIMEOUT):
+        wait_until = time.monotonic() + SNAPSHOT_BUILD_WAIT
+        while time.monotonic() < wait_until:
+            time.sleep(0.05)
+            snapshot_data = cache.get(cache_key)
+            if snapshot_data is not None:
+                return snapshot_data
+        return build_snapshot()
+    try:
+        snapshot_data = build_snapshot()
+        cache.set(cache_key, snapshot_data, SNAPSHOT_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+    return snapshot_data
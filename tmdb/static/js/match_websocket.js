@@ -13,9 +13,114 @@ tmdb_vars_MATCH_STATUS_CODE_COMPLETE = 8;
 
 tmdb_vars_MAX_NUM_RINGS = 9;
 
+// The sequence number of the last update applied to tournament_data (see
+// TournamentUpdate in tmdb/models.py), and the updates received while the
+// data is being loaded or synced.
+tmdb_vars.seq = null;
+tmdb_vars.pending_updates = [];
+tmdb_vars.syncing = false;
+
+tmdb_vars.reconnect_attempts = 0;
+tmdb_vars_MAX_RECONNECT_DELAY = 30000;
+
+// The ring, division and school parameters of the page URL subscribe to the
+// updates of only those rings, divisions and schools (e.g. ?ring=3 on the
+// tablet of ring 3), which are also the matches shown by default.
+tmdb_vars_SUBSCRIPTION_TYPES = ["ring", "division", "school"];
+tmdb_vars.subscription = {};
+tmdb_vars.subscription_query = "";
+
+// With the spectate parameter (e.g. on hallway screens), the page connects
+// as a read-only spectator, which is sent the whole snapshot whenever it
+// connects and the changes a few times per second.
+tmdb_vars.spectate = false;
+
+// With the events parameter, the page receives the updates as Server-Sent
+// Events instead (see MatchUpdateEventsConsumer in tmdb/consumers.py), which
+// the browser reconnects and resumes by itself. The page is then read-only.
+tmdb_vars.use_event_stream = false;
+
+function parse_subscription(search) {
+  var page_params = new URLSearchParams(search);
+  var subscription = {};
+  var query_params = [];
+  tmdb_vars_SUBSCRIPTION_TYPES.map(function(subscription_type) {
+    var ids = page_params.getAll(subscription_type).map(x => parseInt(x)).filter(x => !isNaN(x));
+    if (ids.length) {
+      subscription[subscription_type] = ids;
+      ids.map(x => query_params.push(subscription_type + "=" + x));
+    }
+  });
+  tmdb_vars.subscription = subscription;
+  tmdb_vars.subscription_query = query_params.join("&");
+  tmdb_vars.spectate = page_params.has("spectate");
+  tmdb_vars.use_event_stream = page_params.has("events") && typeof EventSource == "function";
+}
+
+// The rows of the match tables are keyed by match pk, so that updates only
+// patch the rows of the matches which changed (see render_updated_display()).
+// Changes to any other model can affect every row, so they are rendered
+// from scratch.
+tmdb_vars.match_tables = [];
+tmdb_vars.changed_matches = {};
+tmdb_vars.full_render_needed = true;
+
+function mark_datum_changed(datum) {
+  if (datum.model == "tmdb_sparringteammatch") {
+    tmdb_vars.changed_matches[datum.pk] = true;
+  } else {
+    tmdb_vars.full_render_needed = true;
+  }
+}
+
+// Labels which are derived from several models, by the pk of the datum they
+// label, so that rendering and filtering the matches does not follow the
+// registration -> team -> school/division chain for every row. Entries are
+// computed on first use and dropped when a datum they were derived from is
+// stored or deleted.
+function reset_indexes() {
+  tmdb_vars.indexes = {
+    team_registration_label: {},
+    team_registration_school: {},
+    tournament_division_name: {},
+    division_name: {},
+  };
+}
+reset_indexes();
+
+function invalidate_indexes(datum) {
+  var indexes = tmdb_vars.indexes;
+  if (datum.model == "tmdb_sparringteamregistration") {
+    delete indexes.team_registration_label[datum.pk];
+    delete indexes.team_registration_school[datum.pk];
+  } else if (datum.model == "tmdb_tournamentsparringdivision") {
+    delete indexes.tournament_division_name[datum.pk];
+  } else if (datum.model == "tmdb_sparringdivision") {
+    // shared by the labels of many teams, which are not indexed by division
+    delete indexes.division_name[datum.pk];
+    indexes.tournament_division_name = {};
+    indexes.team_registration_label = {};
+  } else if (datum.model == "tmdb_sparringteam") {
+    indexes.team_registration_label = {};
+    indexes.team_registration_school = {};
+  } else if (datum.model == "tmdb_school") {
+    indexes.team_registration_label = {};
+  }
+}
+
+function lookup_index(index_name, pk, compute_entry) {
+  var index = tmdb_vars.indexes[index_name];
+  if (!(pk in index)) {
+    index[pk] = compute_entry(pk);
+  }
+  return index[pk];
+}
+
 function delete_tourament_datum(datum) {
   datum.model = datum.model.replace(".", "_");
   delete tmdb_vars.tournament_data[datum.model][datum.pk];
+  invalidate_indexes(datum);
+  mark_datum_changed(datum);
 }
 
 function store_tournament_datum(datum) {
@@ -28,10 +133,52 @@ function store_tournament_datum(datum) {
     tmdb_vars.tournament_data[datum.model] = {};
   }
   tmdb_vars.tournament_data[datum.model][datum.pk] = datum;
+  invalidate_indexes(datum);
+  mark_datum_changed(datum);
+}
+
+tmdb_vars_COMPACT_FORMAT = "tmdb-compact";
+tmdb_vars_COMPACT_FORMAT_VERSION = 1;
+
+// The columns of every table of the compact snapshot, which updates send
+// their rows in.
+tmdb_vars.columns = {};
+
+function store_compact_table(model, table) {
+  var columns = table.columns;
+  for (var row_num = 0; row_num < table.rows.length; ++row_num) {
+    var row = table.rows[row_num];
+    var datum = {model: model, pk: row[0], fields: {}};
+    for (var column_num = 1; column_num < columns.length; ++column_num) {
+      datum.fields[columns[column_num]] = row[column_num];
+    }
+    store_tournament_datum(datum);
+  }
 }
 
-function store_initial_data(msg_json) {
-  var msg_data = JSON.parse(msg_json);
+function store_compact_data(msg_data) {
+  if (msg_data.version != tmdb_vars_COMPACT_FORMAT_VERSION) {
+    throw "Unsupported snapshot format version: " + msg_data.version;
+  }
+  for (var model in msg_data.tables) {
+    tmdb_vars.columns[model] = msg_data.tables[model].columns;
+    store_compact_table(model, msg_data.tables[model]);
+  }
+}
+
+function store_snapshot(msg_data) {
+  tmdb_vars.full_render_needed = true;
+  reset_indexes();
+  tmdb_vars.row_seqs = {};
+  tmdb_vars.recent_seqs = [];
+  if (msg_data.format == tmdb_vars_COMPACT_FORMAT) {
+    store_compact_data(msg_data);
+    tmdb_vars.seq = msg_data.seq;
+    tmdb_vars.snapshot_seq = msg_data.seq;
+    tmdb_vars.settled_seq = msg_data.seq;
+    return;
+  }
+  tmdb_vars.snapshot_seq = null;
   msg_data.map(store_tournament_datum);
 }
 
@@ -53,8 +200,120 @@ function render_initial_display() {
   render_full_display();
 }
 
+// Patches the rows of the matches changed since the last render, adding and
+// removing rows as matches start or stop passing the filter. The other rows
+// are left alone, so the cost depends only on the number of changed matches.
 function render_updated_display() {
-  render_full_display();
+  if (tmdb_vars.full_render_needed || tmdb_vars.match_tables.length == 0) {
+    render_full_display();
+    return;
+  }
+  var changed_pks = Object.keys(tmdb_vars.changed_matches);
+  tmdb_vars.changed_matches = {};
+  var team_matches = tmdb_vars.tournament_data.tmdb_sparringteammatch;
+  tmdb_vars.match_tables.map(function(match_table) {
+    changed_pks.map(function(pk) {
+      var team_match = team_matches[pk];
+      var match_row = match_table.rows[pk];
+      if (team_match === undefined || !tmdb_vars.team_match_filter(team_match)) {
+        if (match_row !== undefined) {
+          match_row.remove();
+          delete match_table.rows[pk];
+        }
+        return;
+      }
+      if (match_row === undefined) {
+        match_row = create_match_row(team_match);
+        match_table.rows[pk] = match_row;
+        insert_match_row(match_table.body, match_row);
+        return;
+      }
+      var match_number = match_row.match_number;
+      update_match_row(match_row, team_match);
+      if (match_row.match_number != match_number) {
+        match_row.remove();
+        insert_match_row(match_table.body, match_row);
+      }
+    });
+  });
+}
+
+// Inserts match_row into the rows of match_table_body, which are sorted by
+// match number.
+function insert_match_row(match_table_body, match_row) {
+  var rows = match_table_body.children;
+  var low = 0;
+  var high = rows.length;
+  while (low < high) {
+    var mid = (low + high) >> 1;
+    if (rows[mid].match_number <= match_row.match_number) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  match_table_body.insertBefore(match_row, low < rows.length ? rows[low] : null);
+}
+
+function create_match_row(team_match) {
+  var match_row = document.createElement("tr");
+  match_row.match_pk = team_match.pk;
+  match_row.append(createTextElem("td", team_match.fields.number));
+  match_row.append(createTextElem("td", render_round_num(team_match)));
+  match_row.append(createTextElem("td", render_blue_team_name(team_match)));
+  match_row.append(createTextElem("td", render_red_team_name(team_match)));
+  match_row.append(createObjectElem("td", render_report_status(team_match)));
+  match_row.append(createObjectElem("td", render_ring_number(team_match)));
+  match_row.append(createObjectElem("td", render_winning_team(team_match)));
+  var match_status = evaluate_status(team_match);
+  match_row.append(createTextElem("td", match_status.match_status_text));
+  match_row.className = match_status['match_status_css_class'];
+  match_row.match_number = team_match.fields.number;
+  match_row.teams = [team_match.fields.blue_team, team_match.fields.red_team];
+  return match_row;
+}
+
+function set_cell_text(cell, text) {
+  if (text == null) {
+    text = "";
+  }
+  if (cell.textContent != text) {
+    cell.textContent = text;
+  }
+}
+
+// Brings the cells of match_row up to date with team_match in place. The
+// winning team options are only rebuilt if the teams of the match changed.
+function update_match_row(match_row, team_match) {
+  var cells = match_row.children;
+  var match_status = evaluate_status(team_match);
+  var complete = match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_COMPLETE;
+  set_cell_text(cells[0], team_match.fields.number);
+  set_cell_text(cells[1], render_round_num(team_match));
+  set_cell_text(cells[2], render_blue_team_name(team_match));
+  set_cell_text(cells[3], render_red_team_name(team_match));
+
+  var report_status_select = cells[4].firstChild;
+  report_status_select.value = report_status_value(team_match);
+  report_status_select.disabled = complete;
+
+  var ring_field = cells[5].firstChild;
+  ring_field.value = team_match.fields.ring_number ? team_match.fields.ring_number : '';
+  ring_field.disabled = complete;
+
+  if (match_row.teams[0] != team_match.fields.blue_team
+      || match_row.teams[1] != team_match.fields.red_team) {
+    cells[6].replaceChild(render_winning_team(team_match), cells[6].firstChild);
+    match_row.teams = [team_match.fields.blue_team, team_match.fields.red_team];
+  } else {
+    cells[6].firstChild.value = team_match.fields.winning_team;
+  }
+
+  set_cell_text(cells[7], match_status.match_status_text);
+  if (match_row.className != match_status['match_status_css_class']) {
+    match_row.className = match_status['match_status_css_class'];
+  }
+  match_row.match_number = team_match.fields.number;
 }
 
 function set_show_all_filter() {
@@ -63,6 +322,28 @@ function set_show_all_filter() {
   }
 }
 
+function set_subscription_filter() {
+  var subscription = tmdb_vars.subscription;
+  tmdb_vars.team_match_filter = function(team_match) {
+    if (subscription.ring && subscription.ring.indexOf(team_match.fields.ring_number) >= 0) {
+      return true;
+    }
+    if (subscription.division && subscription.division.indexOf(team_match.fields.division) >= 0) {
+      return true;
+    }
+    if (subscription.school) {
+      var team_ids = [team_match.fields.blue_team, team_match.fields.red_team];
+      for (var team_num = 0; team_num < team_ids.length; team_num++) {
+        var school_id = get_school_id_from_team_registration(team_ids[team_num]);
+        if (school_id != null && subscription.school.indexOf(school_id) >= 0) {
+          return true;
+        }
+      }
+    }
+    return false;
+  }
+}
+
 function set_active_matches_filter() {
   tmdb_vars.team_match_filter = function(team_match) {
     var match_status = evaluate_status(team_match);
@@ -222,10 +503,17 @@ function add_filter_options() {
     render_full_display();
   });
 
-  set_show_all_filter();
+  if (tmdb_vars.subscription_query) {
+    set_subscription_filter();
+  } else {
+    set_show_all_filter();
+  }
 }
 
 function render_full_display() {
+  tmdb_vars.match_tables = [];
+  tmdb_vars.changed_matches = {};
+  tmdb_vars.full_render_needed = false;
   var match_queues = document.getElementsByClassName("division-queue");
   for (var i = 0; i < match_queues.length; ++i) {
     match_queue = match_queues[i];
@@ -261,19 +549,12 @@ function render_full_display() {
     });
     var match_queue_table_body = document.createElement("tbody");
     match_queue_table.appendChild(match_queue_table_body);
+    var match_table = {body: match_queue_table_body, rows: {}};
+    tmdb_vars.match_tables.push(match_table);
     team_matches.filter(tmdb_vars.team_match_filter).map(function(team_match) {
-      match_queue_row = document.createElement("tr");
+      match_queue_row = create_match_row(team_match);
+      match_table.rows[team_match.pk] = match_queue_row;
       match_queue_table_body.appendChild(match_queue_row);
-      match_queue_row.append(createTextElem("td", team_match.fields.number));
-      match_queue_row.append(createTextElem("td", render_round_num(team_match)));
-      match_queue_row.append(createTextElem("td", render_blue_team_name(team_match)));
-      match_queue_row.append(createTextElem("td", render_red_team_name(team_match)));
-      match_queue_row.append(createObjectElem("td", render_report_status(team_match)));
-      match_queue_row.append(createObjectElem("td", render_ring_number(team_match)));
-      match_queue_row.append(createObjectElem("td", render_winning_team(team_match)));
-      match_queue_row.append(createTextElem("td", render_status(team_match)));
-      var match_status = evaluate_status(team_match);
-      match_queue_row.className = match_status['match_status_css_class'];
     });
   }
 }
@@ -282,11 +563,11 @@ function get_division(match) {
   if (match == null) {
     return null;
   }
-  var tournament_division = tmdb_vars.tournament_data.tmdb_tournamentsparringdivision[match.fields.division];
-  var division = tmdb_vars.tournament_data.tmdb_sparringdivision[tournament_division.fields.division];
-  var tournamentdivision_id = match.fields.division;
-  var division_str = render_division_name(tournament_division.fields.division);
-return division_str + "";
+  return lookup_index("tournament_division_name", match.fields.division,
+      function(tournament_division_id) {
+    var tournament_division = tmdb_vars.tournament_data.tmdb_tournamentsparringdivision[tournament_division_id];
+    return render_division_name(tournament_division.fields.division) + "";
+  });
 }
 
 function render_round_num(team_match) {
@@ -313,7 +594,15 @@ function render_team_registration(team_registration_id) {
   if (team_registration_id == null) {
     return null;
   }
+  return lookup_index("team_registration_label", team_registration_id,
+      build_team_registration_label);
+}
+
+function build_team_registration_label(team_registration_id) {
   var team_registration = tmdb_vars.tournament_data.tmdb_sparringteamregistration[team_registration_id];
+  if (team_registration.fields.display !== undefined) {
+    return team_registration.fields.display;
+  }
   var team_id = team_registration.fields.team;
   var team = tmdb_vars.tournament_data.tmdb_sparringteam[team_id];
   var school_str = render_school_name(team.fields.school);
@@ -338,6 +627,10 @@ function render_team_composition(team_registration) {
 }
 
 function render_division_name(division_id) {
+  return lookup_index("division_name", division_id, build_division_name);
+}
+
+function build_division_name(division_id) {
   var division = tmdb_vars.tournament_data.tmdb_sparringdivision[division_id];
   var division_sex_str = "Unknown";
   if (division.fields.sex == "F")
@@ -376,16 +669,7 @@ function render_report_status(team_match) {
   select_menu.appendChild(competing_option);
 
 
-  if (team_match.fields.competing) {
-      select_menu.value = tmdb_vars_REPORT_STATUS_COMPETING_VALUE;
-  } else if (team_match.fields.at_ring) {
-    select_menu.value = tmdb_vars_REPORT_STATUS_AT_RING_VALUE;
-  } else if (team_match.fields.in_holding) {
-    select_menu.value = tmdb_vars_REPORT_STATUS_HOLDING_VALUE;
-  }
-  else {
-    select_menu.value = tmdb_vars_REPORT_STATUS_EMPTY_VALUE;
-  }
+  select_menu.value = report_status_value(team_match);
 
   select_menu.name = "report_status";
   select_menu.onchange = function() {
@@ -400,6 +684,19 @@ function render_report_status(team_match) {
   return select_menu;
 }
 
+function report_status_value(team_match) {
+  if (team_match.fields.competing) {
+    return tmdb_vars_REPORT_STATUS_COMPETING_VALUE;
+  }
+  if (team_match.fields.at_ring) {
+    return tmdb_vars_REPORT_STATUS_AT_RING_VALUE;
+  }
+  if (team_match.fields.in_holding) {
+    return tmdb_vars_REPORT_STATUS_HOLDING_VALUE;
+  }
+  return tmdb_vars_REPORT_STATUS_EMPTY_VALUE;
+}
+
 function render_ring_number(team_match) {
   var ring_field = document.createElement("select");
   ring_field.style = "width:50px;"
@@ -463,7 +760,16 @@ function render_status(team_match) {
   return match_status.match_status_text;
 }
 
+// The status is kept with the match, which is replaced by a new object
+// whenever it is updated.
 function evaluate_status(team_match) {
+  if (team_match.match_status === undefined) {
+    team_match.match_status = build_status(team_match);
+  }
+  return team_match.match_status;
+}
+
+function build_status(team_match) {
   if (team_match.fields.winning_team != null) {
     return {
         match_status_css_class: 'team_match_complete',
@@ -507,118 +813,413 @@ function evaluate_status(team_match) {
   };
 }
 
+// The seq of the last update applied to every row, by model and pk. Rows
+// which are not listed were last changed in the snapshot, at
+// tmdb_vars.snapshot_seq.
+tmdb_vars.row_seqs = {};
+tmdb_vars.snapshot_seq = null;
+
+// Records that the row of model with pk is changed by the update seq, and
+// returns false if the row was already changed by that or a later update.
+function claim_row_seq(model, pk, seq) {
+  if (seq === undefined) {
+    return true;
+  }
+  if (tmdb_vars.row_seqs[model] === undefined) {
+    tmdb_vars.row_seqs[model] = {};
+  }
+  var row_seq = tmdb_vars.row_seqs[model][pk];
+  if (row_seq === undefined) {
+    row_seq = tmdb_vars.snapshot_seq;
+  }
+  if (row_seq != null && seq <= row_seq) {
+    return false;
+  }
+  tmdb_vars.row_seqs[model][pk] = seq;
+  return true;
+}
+
+// Updates carry the compact rows of their model, and deletes their pks.
+// The messages of a batch carry their own seq; seq is the one of the
+// enclosing message otherwise.
+function apply_message(data, seq) {
+  if (data.seq !== undefined) {
+    seq = data.seq;
+  }
+  var message_content = data.message_content;
+  if ('update' === data.message_type) {
+    var rows = message_content.filter(row => claim_row_seq(data.model, row[0], seq));
+    store_compact_table(data.model, {columns: tmdb_vars.columns[data.model], rows: rows});
+  }
+  if ('delete' === data.message_type) {
+    message_content.filter(pk => claim_row_seq(data.model, pk, seq)).map(
+        pk => delete_tourament_datum({model: data.model, pk: pk}));
+  }
+  if ('batch' === data.message_type) {
+    message_content.map(sub_message => apply_message(sub_message, seq));
+  }
+}
+
+// Updates of a subscription are sent through one group per subscribed
+// ring, division and school, and the groups are not ordered among each
+// other. tmdb_vars.settled_seq is the highest seq received at least
+// tmdb_vars_UPDATE_REORDER_WINDOW ms ago, so all the updates of the
+// subscription up to it have arrived; a sync starts after it.
+tmdb_vars_UPDATE_REORDER_WINDOW = 5000;
+tmdb_vars.recent_seqs = [];
+tmdb_vars.settled_seq = null;
+
+function note_received_seq(seq) {
+  tmdb_vars.recent_seqs.push([Date.now(), seq]);
+  tmdb_vars.seq = Math.max(tmdb_vars.seq, seq);
+  settle_received_seqs();
+}
+
+function settle_received_seqs() {
+  var now = Date.now();
+  var recent_seqs = tmdb_vars.recent_seqs;
+  while (recent_seqs.length && now - recent_seqs[0][0] >= tmdb_vars_UPDATE_REORDER_WINDOW) {
+    tmdb_vars.settled_seq = Math.max(tmdb_vars.settled_seq, recent_seqs.shift()[1]);
+  }
+  return tmdb_vars.settled_seq;
+}
+
+// Applies an update (or a batch of updates from first_seq to seq) if it
+// follows the last one applied. Updates which were already applied are
+// dropped, and a gap in the sequence triggers a sync.
+function apply_update(data) {
+  if (tmdb_vars.seq == null || tmdb_vars.syncing) {
+    tmdb_vars.pending_updates.push(data);
+    return;
+  }
+  if (tmdb_vars.subscription_query != "") {
+    // The updates of the rest of the tournament are never received, so
+    // gaps cannot be detected, and updates from different groups may come
+    // out of order: every row is applied unless a later update of it was.
+    apply_message(data);
+    note_received_seq(data.seq);
+    return;
+  }
+  if (data.seq <= tmdb_vars.seq) {
+    return;
+  }
+  var first_seq = data.first_seq === undefined ? data.seq : data.first_seq;
+  if (first_seq > tmdb_vars.seq + 1) {
+    tmdb_vars.pending_updates.push(data);
+    sync_updates();
+    return;
+  }
+  apply_message(data);
+  tmdb_vars.seq = data.seq;
+}
+
+function apply_pending_updates() {
+  var pending_updates = tmdb_vars.pending_updates.sort(function(update1, update2) {
+    return update1.seq - update2.seq;
+  });
+  tmdb_vars.pending_updates = [];
+  pending_updates.map(apply_update);
+}
+
 function handle_message(msg) {
   console.log(msg);
-  var data = JSON.parse(msg.data);
+  var data;
+  if (typeof msg.data == "string") {
+    data = JSON.parse(msg.data);
+  } else {
+    data = msgpack_decode(msg.data);
+  }
   var message_type = data.message_type;
   var message_content = data.message_content;
-  if ('update' === message_type) {
-    message_content.map(store_tournament_datum);
-  }
-  if ('delete' === message_type) {
-    var delete_data = JSON.parse(data['delete']);
-    delete_data.map(delete_tourament_datum);
+  if ('ack' === message_type) {
+    finish_request(data.request_id);
+    return;
   }
   if ('error' === message_type) {
+    var request = finish_request(data.request_id);
+    if (request == null) {
+      tmdb_vars.full_render_needed = true;
+    } else {
+      mark_matches_changed(request.match_ids);
+    }
+    if ('conflict' === data.error) {
+      // Show the matches as they are now, which the edit was not based on.
+      store_compact_table(data.model, {columns: tmdb_vars.columns[data.model], rows: data.rows});
+    }
     alert(message_content);
     render_updated_display();
     return
   }
+  if ('snapshot' === message_type) {
+    tmdb_vars.tournament_data = {};
+    tmdb_vars.seq = null;
+    store_snapshot(message_content);
+    apply_pending_updates();
+    render_initial_display();
+    return;
+  }
+  if (data.seq !== undefined) {
+    apply_update(data);
+  } else {
+    apply_message(data);
+  }
   render_updated_display();
 }
 
-function on_websocket_open() {
-  tmdb_vars.tournament_data = {}
-
-  var init_data_req = new XMLHttpRequest();
-  init_data_req.onreadystatechange = function() {
-    if (init_data_req.readyState == 4 && init_data_req.status == 200) {
-      store_initial_data(init_data_req.responseText);
-      render_initial_display();
+// Fetches the updates after tmdb_vars.seq, or the whole snapshot if the
+// server no longer has all of them.
+function sync_updates() {
+  if (tmdb_vars.syncing) {
+    return;
+  }
+  tmdb_vars.syncing = true;
+  var sync_req = new XMLHttpRequest();
+  sync_req.onreadystatechange = function() {
+    if (sync_req.readyState != 4) {
       return;
     }
-    if (init_data_req.readyState == 4) {
-      var err_msg = "Error loading page: HTTP status code ";
-      err_msg += init_data_req.status;
-      err_msg += "\n\nresponse: ";
-      err_msg += init_data_req.responseText;
-      alert(err_msg);
+    tmdb_vars.syncing = false;
+    if (sync_req.status != 200) {
+      console.log("Unable to sync updates: HTTP status code " + sync_req.status);
+      setTimeout(sync_updates, tmdb_vars_MAX_RECONNECT_DELAY);
+      return;
     }
+    var sync_data = JSON.parse(sync_req.responseText);
+    if (sync_data.updates === undefined) {
+      tmdb_vars.tournament_data = {};
+      tmdb_vars.seq = null;
+      store_snapshot(sync_data);
+    } else {
+      sync_data.updates.map(apply_update);
+      if (tmdb_vars.subscription_query != "") {
+        tmdb_vars.seq = Math.max(tmdb_vars.seq, sync_data.seq);
+        tmdb_vars.settled_seq = Math.max(tmdb_vars.settled_seq, sync_data.seq);
+      }
+    }
+    apply_pending_updates();
+    render_updated_display();
   }
-  init_data_req.open("GET", tmdb_vars.initial_tournament_data_url, true);
-  init_data_req.send(null);
+  var since = tmdb_vars.seq;
+  if (tmdb_vars.subscription_query != "") {
+    since = settle_received_seqs();
+  }
+  sync_req.open("GET", tmdb_vars.tournament_updates_url + "&since=" + since, true);
+  sync_req.send(null);
+}
+
+function on_websocket_open() {
+  tmdb_vars.reconnect_attempts = 0;
+  for (var request_id in tmdb_vars.pending_requests) {
+    send_request(request_id);
+  }
+  if (tmdb_vars.seq == null || tmdb_vars.spectate) {
+    // The server sends the snapshot as the first message.
+    return;
+  }
+  // Only fetch what was missed while the connection was down.
+  sync_updates();
 }
 
 function on_websocket_close() {
-  tmdb_vars.match_update_ws.send = function() {
-    alert("Operation failed. The connection to the server has been lost. Please reload the page.");
+  var closed_ws = tmdb_vars.match_update_ws;
+  closed_ws.send = function() {
+    alert("Operation failed. The connection to the server has been lost. Reconnecting...");
+    tmdb_vars.full_render_needed = true;
     render_updated_display();
   }
-  setTimeout(function() {
-    alert("Lost connection to " + tmdb_vars.match_update_ws.url + "\n\nPlease reload the page.");
-  }, 5000);
+  var reconnect_delay = Math.min(1000 * 2**tmdb_vars.reconnect_attempts,
+      tmdb_vars_MAX_RECONNECT_DELAY);
+  tmdb_vars.reconnect_attempts += 1;
+  console.log("Lost connection to " + closed_ws.url + ", reconnecting in " + reconnect_delay + "ms");
+  setTimeout(open_teammatch_websocket, reconnect_delay);
 }
 
-function start_teammatch_websocket(tournament_slug, tournament_json_url) {
-  if (tmdb_vars.match_update_ws != null) {
+function open_teammatch_websocket() {
+  var ws_params = [];
+  if (tmdb_vars.subscription_query) {
+    ws_params.push(tmdb_vars.subscription_query);
+  }
+  if (tmdb_vars.seq == null) {
+    ws_params.push("snapshot=1");
+  }
+  var ws_url = tmdb_vars.match_update_ws_url;
+  if (ws_params.length) {
+    ws_url += "?" + ws_params.join("&");
+  }
+  console.log("Opening connection to " + ws_url);
+  // Binary MessagePack frames are smaller and cheaper to produce, but the
+  // server falls back to JSON text if it does not accept the subprotocol.
+  if (typeof msgpack_decode == "function") {
+    tmdb_vars.match_update_ws = new WebSocket(ws_url, [tmdb_msgpack_SUBPROTOCOL]);
+    tmdb_vars.match_update_ws.binaryType = "arraybuffer";
+  } else {
+    tmdb_vars.match_update_ws = new WebSocket(ws_url);
+  }
+  tmdb_vars.match_update_ws.onmessage = handle_message;
+  tmdb_vars.match_update_ws.onopen = on_websocket_open;
+  tmdb_vars.match_update_ws.onclose = on_websocket_close;
+}
+
+function open_event_stream(tournament_slug) {
+  var events_url = "/tmdb/tournament/sse/tournaments/" + tournament_slug + "/match_updates/";
+  if (tmdb_vars.subscription_query) {
+    events_url += "?" + tmdb_vars.subscription_query;
+  }
+  console.log("Opening event stream " + events_url);
+  tmdb_vars.match_update_events = new EventSource(events_url);
+  tmdb_vars.match_update_events.onmessage = handle_message;
+  tmdb_vars.match_update_events.onerror = function() {
+    console.log("Lost connection to " + events_url + ", reconnecting");
+  };
+}
+
+function start_teammatch_websocket(tournament_slug, tournament_updates_url) {
+  if (tmdb_vars.match_update_ws != null || tmdb_vars.match_update_events != null) {
     return;
   }
   var ws_proto = "wss://"
   if (window.location.protocol == "http:") {
     ws_proto = "ws://"
   }
-  var ws_url = ws_proto + window.location.host + "/tmdb/tournament/ws/tournaments/" + tournament_slug + "/sparring_team_match_updates/";
   tmdb_vars.tournament_data.tournament_slug = tournament_slug;
-  tmdb_vars.initial_tournament_data_url = window.location.protocol + "//" + window.location.host + tournament_json_url;
-  console.log("Opening connection to " + ws_url);
-  tmdb_vars.match_update_ws = new WebSocket(ws_url);
-  tmdb_vars.match_update_ws.onmessage = handle_message;
-  tmdb_vars.match_update_ws.onopen = on_websocket_open;
-  tmdb_vars.match_update_ws.onclose = on_websocket_close;
+  parse_subscription(window.location.search);
+  var ws_path = tmdb_vars.spectate ? "/spectate/" : "/sparring_team_match_updates/";
+  tmdb_vars.match_update_ws_url = ws_proto + window.location.host + "/tmdb/tournament/ws/tournaments/" + tournament_slug + ws_path;
+  tmdb_vars.tournament_updates_url = window.location.protocol + "//" + window.location.host + tournament_updates_url + "?format=compact";
+  if (tmdb_vars.subscription_query) {
+    tmdb_vars.tournament_updates_url += "&" + tmdb_vars.subscription_query;
+  }
+  if (tmdb_vars.use_event_stream) {
+    open_event_stream(tournament_slug);
+    return;
+  }
+  open_teammatch_websocket();
+}
+
+// Sends patches, a list of {match_id, field, value}, which set the fields of
+// matches (see parse_match_patches() in tmdb/consumers.py). Each patch is
+// based on the version of the match shown, so that the server rejects it if
+// the match was changed by someone else in the meantime.
+//
+// The patches are sent as a request with an id, which the server answers
+// with an ack or an error. Until then the request is sent again every
+// tmdb_vars_REQUEST_RETRY_DELAY ms and after every reconnect; the server
+// applies each request only once (see handle_request() in
+// tmdb/consumers.py).
+tmdb_vars.client_seq = 0;
+tmdb_vars.client_id = Math.random().toString(36).slice(2) + Date.now().toString(36);
+tmdb_vars.pending_requests = {};
+tmdb_vars_REQUEST_RETRY_DELAY = 5000;
+tmdb_vars_MAX_REQUEST_ATTEMPTS = 5;
+
+function send_request(request_id) {
+  var request = tmdb_vars.pending_requests[request_id];
+  clearTimeout(request.retry_timer);
+  if (request.attempts >= tmdb_vars_MAX_REQUEST_ATTEMPTS) {
+    delete tmdb_vars.pending_requests[request_id];
+    mark_matches_changed(request.match_ids);
+    alert("Operation failed. The server did not respond.");
+    render_updated_display();
+    return;
+  }
+  if (tmdb_vars.match_update_ws.readyState != WebSocket.OPEN) {
+    // sent by on_websocket_open() once reconnected
+    return;
+  }
+  request.attempts += 1;
+  tmdb_vars.match_update_ws.send(request.message);
+  request.retry_timer = setTimeout(function() {
+    send_request(request_id);
+  }, tmdb_vars_REQUEST_RETRY_DELAY);
+}
+
+function finish_request(request_id) {
+  var request = tmdb_vars.pending_requests[request_id];
+  if (request == undefined) {
+    return null;
+  }
+  clearTimeout(request.retry_timer);
+  delete tmdb_vars.pending_requests[request_id];
+  return request;
+}
+
+// Makes the next render reset the rows of matches whose edit failed, which
+// still show the rejected values.
+function mark_matches_changed(match_ids) {
+  match_ids.map(match_id => tmdb_vars.changed_matches[match_id] = true);
+}
+
+function send_patches(patches) {
+  if (tmdb_vars.use_event_stream) {
+    alert("Matches cannot be changed from this page.");
+    mark_matches_changed(patches.map(patch => patch.match_id));
+    render_updated_display();
+    return;
+  }
+  patches.map(function(patch) {
+    patch.op = "set";
+    var team_match = tmdb_vars.tournament_data.tmdb_sparringteammatch[patch.match_id];
+    if (team_match != undefined && team_match.fields.version != undefined) {
+      patch.version = team_match.fields.version;
+    }
+    tmdb_vars.client_seq += 1;
+    patch.client_seq = tmdb_vars.client_seq;
+  });
+  var request_id = tmdb_vars.client_id + "-" + tmdb_vars.client_seq;
+  tmdb_vars.pending_requests[request_id] = {
+    message: JSON.stringify({request_id: request_id, patches: patches}),
+    match_ids: patches.map(patch => patch.match_id),
+    attempts: 0,
+    retry_timer: null
+  };
+  send_request(request_id);
 }
 
 function on_report_status_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
-  team_match.fields.in_holding = (element.value >= tmdb_vars_REPORT_STATUS_HOLDING_VALUE);
-  team_match.fields.at_ring = (element.value >= tmdb_vars_REPORT_STATUS_AT_RING_VALUE);
-  team_match.fields.competing = (element.value >= tmdb_vars_REPORT_STATUS_COMPETING_VALUE);
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
+  send_patches([
+    {match_id: team_match_pk, field: "in_holding", value: (element.value >= tmdb_vars_REPORT_STATUS_HOLDING_VALUE)},
+    {match_id: team_match_pk, field: "at_ring", value: (element.value >= tmdb_vars_REPORT_STATUS_AT_RING_VALUE)},
+    {match_id: team_match_pk, field: "competing", value: (element.value >= tmdb_vars_REPORT_STATUS_COMPETING_VALUE)},
+  ]);
 }
 
 function on_ring_number_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
+  var ring_number = null;
   if (element.value) {
-    team_match.fields.ring_number = element.value;
-  } else {
-    team_match.fields.ring_number = null;
+    ring_number = parseInt(element.value);
   }
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
+  send_patches([{match_id: team_match_pk, field: "ring_number", value: ring_number}]);
 }
 
 function on_winning_team_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
-  team_match.fields.winning_team = element.value;
-  if (team_match.fields.winning_team == "") {
-    team_match.fields.winning_team = null;
+  var winning_team = null;
+  if (element.value != "") {
+    winning_team = parseInt(element.value);
   }
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
+  send_patches([{match_id: team_match_pk, field: "winning_team", value: winning_team}]);
 }
 
-function get_school_name_from_team_registration(team_registration_id) {
+function get_school_id_from_team_registration(team_registration_id) {
   if (team_registration_id == null) {
     return null;
   }
+  return lookup_index("team_registration_school", team_registration_id,
+      build_team_registration_school);
+}
+
+function build_team_registration_school(team_registration_id) {
   var team_registration = tmdb_vars.tournament_data.tmdb_sparringteamregistration[team_registration_id];
+  if (team_registration.fields.school !== undefined) {
+    return team_registration.fields.school;
+  }
   var team_id = team_registration.fields.team;
   var team = tmdb_vars.tournament_data.tmdb_sparringteam[team_id];
-  return render_school_name(team.fields.school);
+  return team.fields.school;
+}
+
+function get_school_name_from_team_registration(team_registration_id) {
+  if (team_registration_id == null) {
+    return null;
+  }
+  return render_school_name(get_school_id_from_team_registration(team_registration_id));
 }
@@ -0,0 +1,126 @@
+// A minimal MessagePack decoder for the binary frames of the match websocket
+// (see MSGPACK_SUBPROTOCOL in tmdb/consumers.py). Extension types are not
+// used by the server and are not supported.
+
+tmdb_msgpack_SUBPROTOCOL = "tmdb.msgpack";
+
+function msgpack_decode(buffer) {
+  var view = new DataView(buffer);
+  var bytes = new Uint8Array(buffer);
+  var text_decoder = new TextDecoder("utf-8");
+  var offset = 0;
+
+  function read_str(length) {
+    var value = text_decoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  }
+
+  function read_bin(length) {
+    var value = buffer.slice(offset, offset + length);
+    offset += length;
+    return value;
+  }
+
+  function read_array(length) {
+    var value = new Array(length);
+    for (var i = 0; i < length; ++i) {
+      value[i] = read();
+    }
+    return value;
+  }
+
+  function read_map(length) {
+    var value = {};
+    for (var i = 0; i < length; ++i) {
+      var key = read();
+      value[key] = read();
+    }
+    return value;
+  }
+
+  function read_uint(num_bytes) {
+    var value;
+    if (num_bytes == 1) {
+      value = view.getUint8(offset);
+    } else if (num_bytes == 2) {
+      value = view.getUint16(offset);
+    } else if (num_bytes == 4) {
+      value = view.getUint32(offset);
+    } else {
+      value = view.getUint32(offset) * 4294967296 + view.getUint32(offset + 4);
+    }
+    offset += num_bytes;
+    return value;
+  }
+
+  function read_int(num_bytes) {
+    var value;
+    if (num_bytes == 1) {
+      value = view.getInt8(offset);
+    } else if (num_bytes == 2) {
+      value = view.getInt16(offset);
+    } else if (num_bytes == 4) {
+      value = view.getInt32(offset);
+    } else {
+      value = view.getInt32(offset) * 4294967296 + view.getUint32(offset + 4);
+    }
+    offset += num_bytes;
+    return value;
+  }
+
+  function read() {
+    var type = view.getUint8(offset);
+    offset += 1;
+    if (type <= 0x7f) {
+      return type;
+    }
+    if (type >= 0xe0) {
+      return type - 0x100;
+    }
+    if ((type & 0xe0) == 0xa0) {
+      return read_str(type & 0x1f);
+    }
+    if ((type & 0xf0) == 0x90) {
+      return read_array(type & 0x0f);
+    }
+    if ((type & 0xf0) == 0x80) {
+      return read_map(type & 0x0f);
+    }
+    var value;
+    switch (type) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return read_bin(read_uint(1));
+      case 0xc5: return read_bin(read_uint(2));
+      case 0xc6: return read_bin(read_uint(4));
+      case 0xca:
+        value = view.getFloat32(offset);
+        offset += 4;
+        return value;
+      case 0xcb:
+        value = view.getFloat64(offset);
+        offset += 8;
+        return value;
+      case 0xcc: return read_uint(1);
+      case 0xcd: return read_uint(2);
+      case 0xce: return read_uint(4);
+      case 0xcf: return read_uint(8);
+      case 0xd0: return read_int(1);
+      case 0xd1: return read_int(2);
+      case 0xd2: return read_int(4);
+      case 0xd3: return read_int(8);
+      case 0xd9: return read_str(read_uint(1));
+      case 0xda: return read_str(read_uint(2));
+      case 0xdb: return read_str(read_uint(4));
+      case 0xdc: return read_array(read_uint(2));
+      case 0xdd: return read_array(read_uint(4));
+      case 0xde: return read_map(read_uint(2));
+      case 0xdf: return read_map(read_uint(4));
+    }
+    throw "Unsupported MessagePack type: " + type;
+  }
+
+  return read();
+}
@@ -1,3 +1,501 @@
-from django.test import TestCase
+import csv
+import datetime
+import logging
+import os
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+        override_settings
+
+from tmdb import consumers
+from tmdb import models
+from tmdb.util.registration_source import LocalDirectoryRegistrationSource, \
+        RegistrationSourceError
+from tmdb.util.team_file_importer import DIVISION_NAMES, parse_team_file, \
+        TeamFileFormatError
+
+def create_tournament():
+    season = models.Season.objects.create(
+            start_date=datetime.date(2026, 8, 1),
+            end_date=datetime.date(2027, 7, 31))
+    return models.Tournament.objects.create(season=season,
+            location="Test", date=datetime.date(2026, 10, 19),
+            registration_doc_url="https://example.com/test")
+
+class SyncTeamRegistrationsTest(TestCase):
+    def setUp(self):
+        self.tournament = create_tournament()
+        self.division = models.SparringDivision.objects.get(sex='M',
+                skill_level='A')
+
+    def make_teams(self, *teams):
+        return {'Men\'s A': [{
+                'sparring_division': self.division,
+                'school_name': school_name,
+                'team_num': team_num,
+                'has_lightweight': True,
+                'has_middleweight': has_middleweight,
+                'has_heavyweight': True,
+        } for school_name, team_num, has_middleweight in teams]}
+
+    def snapshot_version(self):
+        self.tournament.refresh_from_db()
+        return self.tournament.snapshot_version
+
+    def test_composition_change_bumps_snapshot_version(self):
+        self.tournament.sync_team_registrations(
+                self.make_teams(("Test University", 1, True)))
+        snapshot_version = self.snapshot_version()
+
+        summary = self.tournament.sync_team_registrations(
+                self.make_teams(("Test University", 1, False)))
+
+        self.assertEqual(summary.updated, 1)
+        self.assertGreater(self.snapshot_version(), snapshot_version)
+
+    def test_unchanged_import_keeps_snapshot_version(self):
+        teams = self.make_teams(("Test University", 1, True))
+        self.tournament.sync_team_registrations(teams)
+        snapshot_version = self.snapshot_version()
+
+        self.tournament.sync_team_registrations(teams)
+
+        self.assertEqual(self.snapshot_version(), snapshot_version)
+
+    def test_removing_match_winner_is_rejected(self):
+        self.tournament.sync_team_registrations(self.make_teams(
+                ("Test University", 1, True), ("Other University", 1, True)))
+        winner, loser = models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self.tournament).order_by(
+                'team__school__name')
+        models.SparringTeamMatch.objects.create(
+                division=winner.tournament_division, number=1, round_num=0,
+                round_slot=0, blue_team=winner, red_team=loser,
+                winning_team=winner)
+
+        with self.assertRaises(models.TeamRegistrationInUseError):
+            self.tournament.sync_team_registrations(
+                    self.make_teams(("Test University", 1, True)))
+
+        self.assertEqual(models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self.tournament).count(), 2)
+
+    def test_school_rename_bumps_snapshot_version(self):
+        self.tournament.sync_team_registrations(
+                self.make_teams(("Test University", 1, True)))
+        snapshot_version = self.snapshot_version()
+
+        school = models.School.objects.get(name="Test University")
+        school.name = "Renamed University"
+        school.save()
+
+        self.assertGreater(self.snapshot_version(), snapshot_version)
+
+    def test_school_registration_bumps_snapshot_version(self):
+        school = models.School.objects.create(name="Test University")
+        school_season_registration = models.SchoolSeasonRegistration.objects.create(
+                school=school, season=self.tournament.season, division=1)
+        snapshot_version = self.snapshot_version()
+
+        school_registration = models.SchoolTournamentRegistration.objects.create(
+                tournament=self.tournament,
+                school_season_registration=school_season_registration)
+        self.assertGreater(self.snapshot_version(), snapshot_version)
+        snapshot_version = self.snapshot_version()
+
+        school_registration.delete()
+        self.assertGreater(self.snapshot_version(), snapshot_version)
+
+class LocalDirectoryRegistrationSourceTest(SimpleTestCase):
+    def setUp(self):
+        self.parent_directory = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.parent_directory.name,
+                'registrations')
+        os.mkdir(self.directory)
+        self.source = LocalDirectoryRegistrationSource(self.directory)
+        with open(os.path.join(self.directory, 'school.csv'), 'wb') as fh:
+            fh.write(b'teams')
+        with open(os.path.join(self.parent_directory.name, 'secret'),
+                'wb') as fh:
+            fh.write(b'secret')
+
+    def tearDown(self):
+        self.parent_directory.cleanup()
+
+    def fetch(self, registration_doc_url):
+        return self.source.fetch(models.SchoolTournamentRegistration(
+                registration_doc_url=registration_doc_url))
+
+    def test_file_url_in_directory(self):
+        self.assertEqual(self.fetch('file:school.csv'), b'teams')
+        self.assertEqual(self.fetch('file://%s' %(
+                os.path.join(self.directory, 'school.csv'),)), b'teams')
+
+    def test_file_url_outside_directory_is_rejected(self):
+        for registration_doc_url in ('file://%s' %(os.path.join(
+                        self.parent_directory.name, 'secret'),),
+                'file:../secret', 'file:registrations/../../secret'):
+            with self.assertRaises(RegistrationSourceError):
+                self.fetch(registration_doc_url)
+
+class TeamMatchTestMixin():
+    """Creates a tournament with three teams of different schools in the
+    Men's A division, a semifinal between the first two and a final
+    against the third."""
+    def create_bracket(self):
+        self.tournament = create_tournament()
+        division = models.SparringDivision.objects.get(sex='M',
+                skill_level='A')
+        self.tournament.sync_team_registrations({'Men\'s A': [{
+                'sparring_division': division,
+                'school_name': school_name,
+                'team_num': 1,
+                'has_lightweight': True,
+                'has_middleweight': True,
+                'has_heavyweight': True,
+        } for school_name in ("School 1", "School 2", "School 3")]})
+        self.tournament_division = models.TournamentSparringDivision.objects.get(
+                tournament=self.tournament, division=division)
+        self.teams = list(models.SparringTeamRegistration.objects.filter(
+                tournament_division=self.tournament_division).order_by(
+                'team__school__name'))
+        self.final = models.SparringTeamMatch.objects.create(
+                division=self.tournament_division, number=101, round_num=0,
+                round_slot=0, red_team=self.teams[2])
+        self.semifinal = models.SparringTeamMatch.objects.create(
+                division=self.tournament_division, number=102, round_num=1,
+                round_slot=0, blue_team=self.teams[0], red_team=self.teams[1])
+
+    def get_match(self, match):
+        return models.SparringTeamMatch.objects.get(pk=match.pk)
+
+    def set_winning_team(self, match, team):
+        models.SparringTeamMatch.update_matches(
+                [(match.pk, {'winning_team_id': team and team.pk}, None)])
+
+    def set_ring_number(self, match, ring_number):
+        models.SparringTeamMatch.update_matches(
+                [(match.pk, {'ring_number': ring_number}, None)])
+
+class TeamMatchTest(TeamMatchTestMixin, TestCase):
+    def setUp(self):
+        self.create_bracket()
+
+    def school_key(self, team):
+        return models.TournamentUpdate.subscription_key('school',
+                team.team.school_id)
+
+    def last_update(self, match):
+        return models.TournamentUpdate.objects.filter(
+                object_id=match.pk).latest('sequence')
+
+    def test_removed_team_school_receives_update(self):
+        self.set_winning_team(self.semifinal, self.teams[0])
+        self.set_winning_team(self.semifinal, None)
+
+        self.assertIn(self.school_key(self.teams[0]),
+                self.last_update(self.final).get_subscription_keys())
+
+    def test_removed_team_school_receives_update_on_save(self):
+        final = self.get_match(self.final)
+        final.red_team = self.teams[1]
+        final.save()
+
+        self.assertEqual(self.last_update(final).get_subscription_keys(),
+                sorted([models.TournamentUpdate.subscription_key('division',
+                        self.tournament_division.pk),
+                        self.school_key(self.teams[1]),
+                        self.school_key(self.teams[2])]))
+
+    def test_stale_save_is_rejected(self):
+        stale_final = self.get_match(self.final)
+        self.set_ring_number(self.final, 1)
+
+        stale_final.ring_number = 2
+        with self.assertRaises(models.MatchConflictError):
+            stale_final.save()
+
+        final = self.get_match(self.final)
+        self.assertEqual((final.ring_number, final.version), (1, 1))
+
+    def test_save_increments_version(self):
+        final = self.get_match(self.final)
+        final.ring_number = 1
+        final.save()
+        final.ring_number = 2
+        final.save()
+
+        self.assertEqual(self.get_match(self.final).version, 2)
+
+    def division_match_counts(self):
+        self.tournament_division.refresh_from_db()
+        return (self.tournament_division.num_matches,
+                self.tournament_division.num_matches_completed)
+
+    def test_division_match_counts(self):
+        self.assertEqual(self.division_match_counts(), (2, 0))
+
+        self.set_winning_team(self.semifinal, self.teams[0])
+        self.assertEqual(self.division_match_counts(), (2, 1))
+
+        final = self.get_match(self.final)
+        final.winning_team = self.teams[0]
+        final.save()
+        self.assertEqual(self.division_match_counts(), (2, 2))
+
+        final.winning_team = None
+        final.save()
+        self.assertEqual(self.division_match_counts(), (2, 1))
+
+        self.get_match(self.semifinal).delete()
+        self.assertEqual(self.division_match_counts(), (1, 0))
+
+        models.TournamentSparringDivision.recount_matches()
+        self.assertEqual(self.division_match_counts(), (1, 0))
+
+    def test_update_matches_rejects_stale_version(self):
+        self.set_ring_number(self.final, 1)
+
+        with self.assertRaises(models.MatchConflictError) as cm:
+            models.SparringTeamMatch.update_matches([
+                    (self.semifinal.pk, {'ring_number': 2}, 0),
+                    (self.final.pk, {'ring_number': 2}, 0)])
+
+        self.assertEqual([match.pk for match in cm.exception.matches],
+                [self.final.pk])
+        self.assertIsNone(self.get_match(self.semifinal).ring_number)
+        self.assertEqual(self.get_match(self.final).ring_number, 1)
+
+    def test_update_matches_detects_concurrent_change(self):
+        fetch_bracket_slots = models.SparringTeamMatch.fetch_bracket_slots
+        def fetch_changed_bracket_slots(bracket_slots, matches_by_slot):
+            # someone else changes the final after it was read
+            fetch_bracket_slots(bracket_slots, matches_by_slot)
+            models.SparringTeamMatch.objects.filter(pk=self.final.pk).update(
+                    version=F('version') + 1)
+
+        with mock.patch.object(models.SparringTeamMatch,
+                'fetch_bracket_slots', side_effect=fetch_changed_bracket_slots):
+            with self.assertRaises(models.MatchConflictError):
+                self.set_winning_team(self.semifinal, self.teams[0])
+
+        self.assertIsNone(self.get_match(self.semifinal).winning_team_id)
+        self.assertIsNone(self.get_match(self.final).blue_team_id)
+        self.assertEqual(self.division_match_counts(), (2, 0))
+
+class TournamentUpdateTest(TeamMatchTestMixin, TestCase):
+    def setUp(self):
+        self.create_bracket()
+        self.tournament.refresh_from_db()
+        self.sequence = self.tournament.snapshot_version
+
+    def updates_since(self, sequence, subscription_keys=None):
+        self.tournament.refresh_from_db()
+        return models.TournamentUpdate.updates_since(self.tournament,
+                sequence, subscription_keys)
+
+    def test_updates_since(self):
+        self.set_ring_number(self.final, 1)
+        self.set_ring_number(self.semifinal, 2)
+
+        updates = self.updates_since(self.sequence)
+        self.assertEqual([(update.sequence, update.object_id)
+                for update in updates],
+                [(self.sequence + 1, self.final.pk),
+                        (self.sequence + 2, self.semifinal.pk)])
+        updates = self.updates_since(self.sequence,
+                [models.TournamentUpdate.subscription_key('ring', 2)])
+        self.assertEqual([update.object_id for update in updates],
+                [self.semifinal.pk])
+        self.assertEqual(self.updates_since(self.sequence + 2), [])
+
+    def test_updates_since_without_history(self):
+        # changes to team registrations are not recorded as updates
+        team_registration = self.teams[0]
+        team_registration.points = 3
+        team_registration.save()
+        self.set_ring_number(self.final, 1)
+
+        self.assertIsNone(self.updates_since(self.sequence))
+        self.assertEqual(len(self.updates_since(
+                self.tournament.snapshot_version - 1)), 1)
+        self.assertIsNone(self.updates_since(
+                self.tournament.snapshot_version + 1))
+
+@override_settings(PUBLISH_TOURNAMENT_UPDATES_ON_COMMIT=True,
+        CHANNEL_LAYERS={'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class TournamentUpdatePublishTest(TeamMatchTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.create_bracket()
+        self.published_sequences = []
+        models.tournament_updated.connect(self.record_published_sequences)
+        self.addCleanup(models.tournament_updated.disconnect,
+                self.record_published_sequences)
+
+    def record_published_sequences(self, sender, tournament_id,
+            tournament_updates, **kwargs):
+        self.published_sequences.append([tournament_update.sequence
+                for tournament_update in tournament_updates])
+
+    def unpublished_sequences(self):
+        return list(models.TournamentUpdate.objects.filter(
+                published=False).order_by('sequence').values_list(
+                'sequence', flat=True))
+
+    def test_updates_are_published_on_commit(self):
+        with transaction.atomic():
+            self.set_ring_number(self.final, 1)
+            self.set_ring_number(self.semifinal, 2)
+            self.assertEqual(self.published_sequences, [])
+            sequences = self.unpublished_sequences()
+
+        self.assertEqual(len(sequences), 2)
+        self.assertEqual(self.published_sequences, [sequences])
+        self.assertEqual(self.unpublished_sequences(), [])
+
+    def test_rolled_back_updates_are_not_published(self):
+        with transaction.atomic():
+            self.set_ring_number(self.final, 1)
+            try:
+                with transaction.atomic():
+                    self.set_ring_number(self.semifinal, 2)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            sequences = self.unpublished_sequences()
+
+        self.assertEqual(len(sequences), 1)
+        self.assertEqual(self.published_sequences, [sequences])
+
+    def test_failed_publish_is_sent_with_next_updates(self):
+        with mock.patch.object(models.TournamentUpdate, 'publish',
+                side_effect=ConnectionError):
+            with self.assertLogs('tmdb.models', logging.ERROR):
+                self.set_ring_number(self.final, 1)
+        sequences = self.unpublished_sequences()
+        self.assertEqual(len(sequences), 1)
+
+        self.set_ring_number(self.semifinal, 2)
+
+        self.assertEqual(self.published_sequences,
+                [[sequences[0], sequences[0] + 1]])
+        self.assertEqual(self.unpublished_sequences(), [])
+
+@override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SparringTeamMatchConsumerTest(TeamMatchTestMixin, TestCase):
+    def setUp(self):
+        self.create_bracket()
+        cache.clear()
+        self.consumer = consumers.SparringTeamMatchConsumer({
+                'type': 'websocket',
+                'user': User.objects.create_superuser('admin',
+                        'admin@example.com', 'password'),
+        })
+        self.consumer.tournament_slug = self.tournament.slug
+
+    def handle_request(self, request_id, ring_number):
+        return self.consumer.handle_request(request_id, [{'op': 'set',
+                'match_id': self.final.pk, 'field': 'ring_number',
+                'value': ring_number, 'client_seq': 1}])
+
+    def test_repeated_request_is_applied_once(self):
+        answer = self.handle_request('request-1', 1)
+        self.assertEqual(answer, {'message_type': 'ack',
+                'request_id': 'request-1', 'client_seqs': [1]})
+
+        self.assertEqual(self.handle_request('request-1', 1), answer)
+        self.assertEqual(self.get_match(self.final).version, 1)
+
+    def test_pending_request_is_not_answered(self):
+        cache.add(consumers.request_cache_key(self.tournament.slug,
+                'request-1'), consumers.REQUEST_PENDING)
+
+        self.assertIsNone(self.handle_request('request-1', 1))
+        self.assertIsNone(self.get_match(self.final).ring_number)
+
+    def test_failed_request_is_applied_again(self):
+        with mock.patch.object(consumers.SparringTeamMatchConsumer,
+                'apply_update_message', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.handle_request('request-1', 1)
+
+        self.assertEqual(self.handle_request('request-1', 1)['message_type'],
+                'ack')
+        self.assertEqual(self.get_match(self.final).ring_number, 1)
+
+    def test_error_answer_is_kept(self):
+        self.consumer.scope['user'] = AnonymousUser()
+
+        answer = self.handle_request('request-1', 1)
+        self.assertEqual(answer['message_type'], 'error')
+
+        self.consumer.scope['user'] = User.objects.get(username='admin')
+        self.assertEqual(self.handle_request('request-1', 1), answer)
+        self.assertIsNone(self.get_match(self.final).ring_number)
+
+class TeamFileFormatTest(SimpleTestCase):
+    def team_file(self, *rows):
+        team_file = StringIO()
+        csv.writer(team_file).writerows(rows)
+        return BytesIO(team_file.getvalue().encode('utf-8'))
+
+    def parse(self, *rows):
+        return parse_team_file(self.team_file(*rows),
+                get_sparring_division=lambda division_name: division_name)
+
+    def num_teams_row(self, num_mens_a_teams=1):
+        return ["%d Teams" %(num_mens_a_teams,)] \
+                + ["0 Teams"] * (len(DIVISION_NAMES) - 1)
+
+    def empty_row(self):
+        return [""] * len(DIVISION_NAMES)
+
+    def assertFormatError(self, message, *rows):
+        with self.assertRaises(TeamFileFormatError) as cm:
+            self.parse(*rows)
+        self.assertEqual(str(cm.exception), message)
+
+    def test_parse(self):
+        teams = self.parse(DIVISION_NAMES, self.num_teams_row(), self.empty_row(),
+                ["Test University Men's A1 - (LH)"])
+
+        self.assertEqual(teams["Men's A"], [{
+                'sparring_division': "Men's A",
+                'school_name': "Test University",
+                'team_num': 1,
+                'has_lightweight': True,
+                'has_middleweight': False,
+                'has_heavyweight': True,
+        }])
+
+    def test_empty_file(self):
+        self.assertFormatError("Team file is empty")
+
+    def test_header_errors(self):
+        self.assertFormatError("Unknown columns in header: Mixed A (column 8)",
+                DIVISION_NAMES + ["Mixed A"])
+        self.assertFormatError("Missing columns in header: Poomsae",
+                DIVISION_NAMES[:-1])
+        self.assertFormatError(
+                "Division [Men's A] appears in both column 1 and 8",
+                DIVISION_NAMES + ["Men's A"])
+
+    def test_row_errors(self):
+        self.assertFormatError(
+                "Row 2, column 1 (Men's A): expected 'N Teams', got [one]",
+                DIVISION_NAMES, ["one"] + self.num_teams_row()[1:])
+        self.assertFormatError(
+                "Row 4, column 1 (Men's A): unable to parse team [Test University]",
+                DIVISION_NAMES, self.num_teams_row(), self.empty_row(), ["Test University"])
+        self.assertFormatError(
+                "Men's A: header lists 2 teams but 1 were found",
+                DIVISION_NAMES, self.num_teams_row(2), self.empty_row(),
+                ["Test University Men's A1 - (LH)"])
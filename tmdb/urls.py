@@ -74,6 +74,14 @@ urlpatterns = [
     url(tournament_base
             + r'/json_data/*$',
             views.tournament_view.tournament_json, name='tournament_json'),
+    url(tournament_base
+            + r'/updates_json/*$',
+            views.tournament_view.tournament_updates_json,
+            name='tournament_updates_json'),
+    url(tournament_base
+            + r'/status_json/*$',
+            views.tournament_view.tournament_status_json,
+            name='tournament_status_json'),
 
     # tournament import
     url(tournament_base
@@ -195,6 +203,8 @@ urlpatterns = [
             views.settings_view.create_ringtable_user, name='create_ringtable_user'),
     url(r'^registration_credentials/*$', views.settings_view.registration_credentials,
             name='registration_credentials'),
+    url(r'^registration_directory/*$', views.settings_view.registration_directory,
+            name='registration_directory'),
     url(r'^settings/*/$', views.settings_view.settings, name='settings'),
     url(r'^auth/*/', include('django.contrib.auth.urls')),
     url(r'^$', views.settings_view.index, name='index'),
@@ -1,3 +1,3 @@
 from .bracket_generator import *
 from .slot_assigner import *
-from .team_file_importer import parse_team_file
+from .team_file_importer import parse_team_file, TeamFileFormat, TeamFileFormatError
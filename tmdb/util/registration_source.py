@@ -0,0 +1,122 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from tmdb import models
+
+__all__ = ['RegistrationDocument', 'RegistrationSource',
+        'RegistrationSourceError', 'LocalDirectoryRegistrationSource',
+        'get_registration_source']
+
+class RegistrationSourceError(Exception): pass
+
+class RegistrationDocument():
+    """The contents of one school's registration document.
+
+    content_hash identifies the contents, and is stored on the
+    SchoolTournamentRegistration when it is imported so that an unchanged
+    document can be skipped on re-import.
+    """
+    def __init__(self, school_registration, content):
+        self.school_registration = school_registration
+        self.content = content
+        self.content_hash = hashlib.sha256(content).hexdigest()
+
+class RegistrationSource():
+    """Where the registration documents of schools are fetched from.
+
+    Subclasses implement fetch(), which returns the raw bytes of the
+    document of a single SchoolTournamentRegistration (or raises
+    RegistrationSourceError). fetch() is called from worker threads by
+    fetch_all(), so it must not perform any database queries; the school
+    registrations passed in should have school_season_registration__school
+    selected already.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+
+    def fetch(self, school_registration):
+        raise NotImplementedError()
+
+    def fetch_document(self, school_registration):
+        return RegistrationDocument(school_registration,
+                self.fetch(school_registration))
+
+    def _fetch_document_or_error(self, school_registration):
+        try:
+            return self.fetch_document(school_registration), None
+        except RegistrationSourceError as e:
+            return None, e
+
+    def fetch_all(self, school_registrations):
+        """Fetches the documents of school_registrations concurrently.
+
+        At most max_workers documents are fetched at a time. Returns a list
+        of (school_registration, document, error) tuples in the same order
+        as school_registrations, where exactly one of document and error is
+        None.
+        """
+        school_registrations = list(school_registrations)
+        if not school_registrations:
+            return []
+        num_workers = min(self.max_workers, len(school_registrations))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(self._fetch_document_or_error,
+                    school_registrations)
+            return [(school_registration, document, error)
+                    for school_registration, (document, error)
+                    in zip(school_registrations, results)]
+
+class LocalDirectoryRegistrationSource(RegistrationSource):
+    """Reads registration documents from a local directory.
+
+    This stands in for the Google Drive registration spreadsheets when
+    running offline. The document of a school is the file named by a
+    file:// registration_doc_url if there is one, and
+    <directory>/<school slug>.csv otherwise. Documents use the team file
+    format (see tmdb.util.team_file_importer) and list only the teams of
+    that school. Files outside of the directory are never read, whatever
+    the registration_doc_url.
+    """
+    def __init__(self, directory, max_workers=4):
+        super().__init__(max_workers=max_workers)
+        self.directory = directory
+
+    def document_path(self, school_registration):
+        doc_url = school_registration.registration_doc_url
+        if doc_url and urlparse(doc_url).scheme == 'file':
+            document_path = os.path.join(self.directory,
+                    urlparse(doc_url).path)
+        else:
+            school = school_registration.school_season_registration.school
+            document_path = os.path.join(self.directory,
+                    school.slug + '.csv')
+        directory = os.path.realpath(self.directory)
+        document_path = os.path.realpath(document_path)
+        if os.path.commonpath([directory, document_path]) != directory:
+            raise RegistrationSourceError(
+                    "Registration document %s is outside of the registration directory" %(
+                    document_path,))
+        return document_path
+
+    def fetch(self, school_registration):
+        document_path = self.document_path(school_registration)
+        try:
+            with open(document_path, 'rb') as document_fh:
+                return document_fh.read()
+        except IOError as e:
+            raise RegistrationSourceError(
+                    "Unable to read registration document %s: %s" %(
+                    document_path, e.strerror))
+
+def get_registration_source(max_workers=4):
+    """Returns the RegistrationSource configured in the
+    ConfigurationSettings."""
+    directory = models.ConfigurationSetting.objects.filter(
+            key=models.ConfigurationSetting.REGISTRATION_DIRECTORY).first()
+    if directory is not None and directory.value.strip():
+        return LocalDirectoryRegistrationSource(directory.value.strip(),
+                max_workers=max_workers)
+    raise RegistrationSourceError("No registration source is configured."
+            + " Set the registration directory in the settings.")
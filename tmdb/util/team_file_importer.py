@@ -7,7 +7,7 @@ from tmdb import models
 
 NUM_TEAMS_RE = re.compile('(?P<num_teams>\d+) Teams')
 
-__all__ = ['parse_team_file']
+__all__ = ['parse_team_file', 'TeamFileFormat', 'TeamFileFormatError']
 
 DIVISION_NAMES = [
     "Men's A",
@@ -19,6 +19,8 @@ DIVISION_NAMES = [
     "Poomsae"
 ]
 
+class TeamFileFormatError(ValueError): pass
+
 def _generate_division_re(division_name):
     return re.compile(f' {division_name}(?P<team_num>\d+) - \('
             + '(?P<has_lightweight>L?)'
@@ -26,48 +28,142 @@ def _generate_division_re(division_name):
             + '(?P<has_heavyweight>H?)'
             + '\)$')
 
-def parse_team_file(team_file):
-    team_file_data = team_file.read().decode('utf-8')
-    teams_fh = StringIO(team_file_data)
-    teams_csv = csv.DictReader(teams_fh)
-    # ignore first two rows of the file (they are empty)
-    num_teams = _parse_num_teams(next(teams_csv))
-    next(teams_csv)
+DIVISION_RE_PATTERNS = {division_name: _generate_division_re(division_name)
+        for division_name in DIVISION_NAMES}
 
-    teams = defaultdict(list)
+class TeamFileFormat():
+    """The column layout of a team file.
 
-    division_re_patterns = {}
-    for division_name in DIVISION_NAMES:
-        division_re_patterns[division_name] = _generate_division_re(
-                division_name)
+    A team file has a header row naming one column per division, a row
+    holding the number of teams in each division ("N Teams"), an empty row
+    and then one row per team. The header is resolved to column indexes
+    once, so parsing a row only visits the division columns and reuses the
+    precompiled regexes. Use TeamFileFormat.from_header() to share formats
+    between parses.
+    """
+    _formats_by_header = {}
 
-    for team_row in teams_csv:
-        for division_name in DIVISION_NAMES:
-            if not team_row[division_name]:
+    def __init__(self, header):
+        self.header = tuple(header)
+        self.division_columns = []
+        columns_by_division = {}
+        unknown_columns = []
+        for column_index, column_name in enumerate(self.header):
+            column_name = column_name.strip()
+            if not column_name:
+                continue
+            if column_name not in DIVISION_RE_PATTERNS:
+                unknown_columns.append("%s (column %d)" %(
+                        column_name, column_index + 1))
                 continue
-            sparring_division = _get_sparring_division(division_name)
-            team_cell = team_row[division_name]
-            match = division_re_patterns[division_name].search(team_cell)
-            school_name = team_cell[:match.span()[0]]
-            team_data = {
-                    'sparring_division': sparring_division,
-                    'school_name': school_name,
-                    'team_num': int(match.group('team_num')),
-                    'has_lightweight': bool(match.group('has_lightweight')),
-                    'has_middleweight': bool(match.group('has_middleweight')),
-                    'has_heavyweight': bool(match.group('has_heavyweight')),
-            }
-            teams[division_name].append(team_data)
-    for division_name in DIVISION_NAMES:
-        assert len(teams[division_name]) == num_teams[division_name]
-    return teams
-
-def _parse_num_teams(num_teams_row):
-    num_teams = {}
-    for division_name in DIVISION_NAMES:
-        match = re.match(NUM_TEAMS_RE, num_teams_row[division_name])
-        num_teams[division_name] = int(match.group('num_teams'))
-    return num_teams
+            if column_name in columns_by_division:
+                raise TeamFileFormatError(
+                        "Division [%s] appears in both column %d and %d" %(
+                        column_name, columns_by_division[column_name] + 1,
+                        column_index + 1))
+            columns_by_division[column_name] = column_index
+        if unknown_columns:
+            raise TeamFileFormatError("Unknown columns in header: %s" %(
+                    ", ".join(unknown_columns)))
+        missing_columns = [division_name for division_name in DIVISION_NAMES
+                if division_name not in columns_by_division]
+        if missing_columns:
+            raise TeamFileFormatError("Missing columns in header: %s" %(
+                    ", ".join(missing_columns)))
+        for division_name in DIVISION_NAMES:
+            self.division_columns.append((columns_by_division[division_name],
+                    division_name, DIVISION_RE_PATTERNS[division_name]))
+
+    @classmethod
+    def from_header(cls, header):
+        header = tuple(header)
+        team_file_format = cls._formats_by_header.get(header)
+        if team_file_format is None:
+            team_file_format = cls(header)
+            cls._formats_by_header[header] = team_file_format
+        return team_file_format
+
+    @staticmethod
+    def _cell(row, column_index):
+        if column_index < len(row):
+            return row[column_index]
+        return ''
+
+    def parse_num_teams(self, num_teams_row, row_num=2):
+        num_teams = {}
+        for column_index, division_name, _ in self.division_columns:
+            cell = self._cell(num_teams_row, column_index)
+            match = NUM_TEAMS_RE.match(cell)
+            if not match:
+                raise TeamFileFormatError(
+                        "Row %d, column %d (%s): expected 'N Teams', got [%s]" %(
+                        row_num, column_index + 1, division_name, cell))
+            num_teams[division_name] = int(match.group('num_teams'))
+        return num_teams
+
+    def parse_rows(self, rows, get_sparring_division=None):
+        """Parses the rows of a team file that follow the header row.
+
+        Returns a dict of team lists keyed by division name (see
+        parse_team_file()).
+        """
+        if get_sparring_division is None:
+            get_sparring_division = _get_sparring_division
+        # blank lines are skipped, the first row after the header holds the
+        # team counts and the one after it is empty
+        numbered_rows = ((row_num, row)
+                for row_num, row in enumerate(rows, start=2) if row)
+        num_teams_row_num, num_teams_row = next(numbered_rows, (2, []))
+        num_teams = self.parse_num_teams(num_teams_row, num_teams_row_num)
+        next(numbered_rows, None)
+
+        division_columns = [(column_index, division_name, division_re,
+                get_sparring_division(division_name))
+                for column_index, division_name, division_re
+                in self.division_columns]
+
+        teams = defaultdict(list)
+        for row_num, team_row in numbered_rows:
+            num_cells = len(team_row)
+            for (column_index, division_name, division_re,
+                    sparring_division) in division_columns:
+                if column_index >= num_cells:
+                    continue
+                team_cell = team_row[column_index]
+                if not team_cell:
+                    continue
+                match = division_re.search(team_cell)
+                if not match:
+                    raise TeamFileFormatError(
+                            "Row %d, column %d (%s): unable to parse team [%s]" %(
+                            row_num, column_index + 1, division_name,
+                            team_cell))
+                team_data = {
+                        'sparring_division': sparring_division,
+                        'school_name': team_cell[:match.start()],
+                        'team_num': int(match.group('team_num')),
+                        'has_lightweight': bool(match.group('has_lightweight')),
+                        'has_middleweight': bool(match.group('has_middleweight')),
+                        'has_heavyweight': bool(match.group('has_heavyweight')),
+                }
+                teams[division_name].append(team_data)
+        for division_name in DIVISION_NAMES:
+            if len(teams[division_name]) != num_teams[division_name]:
+                raise TeamFileFormatError(
+                        "%s: header lists %d teams but %d were found" %(
+                        division_name, num_teams[division_name],
+                        len(teams[division_name])))
+        return teams
+
+def parse_team_file(team_file, get_sparring_division=None):
+    team_file_data = team_file.read().decode('utf-8')
+    teams_csv = csv.reader(StringIO(team_file_data))
+    header = next(teams_csv, None)
+    if header is None:
+        raise TeamFileFormatError("Team file is empty")
+    team_file_format = TeamFileFormat.from_header(header)
+    return team_file_format.parse_rows(teams_csv,
+            get_sparring_division=get_sparring_division)
 
 def _get_sparring_division(division_name):
     if division_name.strip().startswith("Poomsae"):
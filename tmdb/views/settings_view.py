@@ -24,11 +24,12 @@ def index(request):
 def settings(request):
     return render(request, 'tmdb/settings.html')
 
-@permission_required("tmdb.change_configurationsetting")
-def registration_credentials(request):
+def configuration_setting(request, setting_key, setting_name, form_action):
     template_name = 'tmdb/configuration_setting.html'
-    context = {"setting_name": "Registration Import Credentials"}
-    setting_key = models.ConfigurationSetting.REGISTRATION_CREDENTIALS
+    context = {
+        "setting_name": setting_name,
+        "form_action": form_action,
+    }
     existing_setting = models.ConfigurationSetting.objects.filter(
             key=setting_key).first()
     if request.method == 'POST':
@@ -43,6 +44,20 @@ def registration_credentials(request):
     context['form'] = form
     return render(request, 'tmdb/configuration_setting.html', context)
 
+@permission_required("tmdb.change_configurationsetting")
+def registration_credentials(request):
+    return configuration_setting(request,
+            models.ConfigurationSetting.REGISTRATION_CREDENTIALS,
+            "Registration Import Credentials",
+            reverse('tmdb:registration_credentials'))
+
+@permission_required("tmdb.change_configurationsetting")
+def registration_directory(request):
+    return configuration_setting(request,
+            models.ConfigurationSetting.REGISTRATION_DIRECTORY,
+            "Registration Document Directory",
+            reverse('tmdb:registration_directory'))
+
 @permission_required("auth.add_user")
 def create_headtable_user(request):
     template_name = 'tmdb/add_user.html'
@@ -7,6 +7,7 @@ from django.urls import reverse
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth import models as auth_models
 from django.contrib import messages
+from django.db import transaction
 
 from tmdb import forms
 from tmdb import models
@@ -30,10 +31,16 @@ def update_teammatch_status(request, tournament_slug, division_slug, match_num):
     }
     if request.method == 'POST':
         team_match_form = forms.MatchForm(request.POST, instance=team_match)
-        if team_match_form.is_valid():
-            team_match_form.save()
-            return HttpResponseRedirect(reverse("tmdb:match_list",
-                    args=(tournament_slug,)))
+        try:
+            # validating the form moves the winning team to the next round
+            # match, which is rolled back if the match can not be saved
+            with transaction.atomic():
+                if team_match_form.is_valid():
+                    team_match_form.save()
+                    return HttpResponseRedirect(reverse("tmdb:match_list",
+                            args=(tournament_slug,)))
+        except models.MatchConflictError as e:
+            team_match_form.add_error(None, str(e))
     else:
         team_match_form = forms.MatchForm(instance=team_match)
         match_teams = []
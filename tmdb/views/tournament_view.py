@@ -1,21 +1,31 @@
 import json
 
 from django.shortcuts import redirect, render, get_object_or_404
-from django.core import serializers
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, \
+        StreamingHttpResponse
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth import models as auth_models
 from django.contrib import messages
+from django.utils.cache import patch_cache_control
+from django.utils.text import compress_sequence
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
 
 from tmdb import forms
 from tmdb import models
+from tmdb.snapshot import get_snapshot_json, stream_snapshot_json, \
+        SNAPSHOT_FORMATS
 
 from collections import defaultdict, OrderedDict
 import datetime
+import re
 
 from tmdb.util.match_sheet import create_match_sheets
 from tmdb.util.bracket_svg import SvgBracket
+from tmdb.util import TeamFileFormatError
+from tmdb.util.registration_source import get_registration_source, \
+        RegistrationSourceError
 
 def tournaments(request, tournament_slug=None):
     seasons = models.Season.objects.order_by('-start_date')
@@ -97,7 +107,17 @@ def tournament_import(request, tournament_slug):
         upload_form = forms.TournamentImportForm(
                 request.POST, request.FILES, instance=instance)
         if upload_form.is_valid():
-            instance.import_school_registrations(request.FILES['team_file'])
+            try:
+                import_summary = instance.import_school_registrations(
+                        request.FILES['team_file'],
+                        incremental=upload_form.cleaned_data['incremental'])
+            except (TeamFileFormatError,
+                    models.TeamRegistrationInUseError) as e:
+                messages.error(request, "Unable to import teams: %s" %(e,),
+                        extra_tags="alert alert-danger")
+            else:
+                messages.info(request, "Imported teams: %s" %(import_summary,),
+                        extra_tags="alert alert-info")
             return HttpResponseRedirect(reverse('tmdb:tournament_dashboard',
                     args=(tournament_slug,)))
     else:
@@ -108,7 +128,8 @@ def tournament_import(request, tournament_slug):
 def tournament_dashboard(request, tournament_slug):
     tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
     tournament_divisions = models.TournamentSparringDivision.objects.filter(
-            tournament=tournament).order_by(
+            tournament=tournament).select_related(
+            'tournament', 'division').order_by(
             'division__sex', 'division__skill_level')
 
     context = {
@@ -117,64 +138,103 @@ def tournament_dashboard(request, tournament_slug):
     }
     return render(request, 'tmdb/tournament_dashboard.html', context)
 
-def model_to_json(query_set, fields):
-    obj_json = serializers.serialize('json', query_set, fields=fields)
-    return json.loads(obj_json)
+def tournament_status_json(request, tournament_slug):
+    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
+    tournament_divisions = models.TournamentSparringDivision.objects.filter(
+            tournament=tournament)
+    msg = {tournament_division.pk: tournament_division.status().to_json()
+            for tournament_division in tournament_divisions}
+    return HttpResponse(json.dumps(msg), content_type="application/json")
+
+def get_snapshot_format(request):
+    snapshot_format = request.GET.get('format', 'list')
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        return 'list'
+    return snapshot_format
+
+accepts_gzip_re = re.compile(r'\bgzip\b')
 
-json_fields = {
-    'tournament': ('id', 'location', 'date',),
-    'division': ('id', 'sex', 'skill_level',),
-    'school': ('id', 'name',),
-    'team': ('id', 'division', 'school', 'number',),
-    'tournament_division': ('id', 'division', 'tournament',),
-    'school_tournament_registration': ('id', 'school_season_registration',
-                    'tournament',),
-    'school_season_registration': ('id', 'school',),
-    'team_registration': ('id', 'lightweight', 'middleweight', 'heavyweight',
-                    'alternate1', 'alternate2', 'team', 'tournament_division',
-                    'points', 'seed',),
-    'team_match': ('id', 'blue_team', 'red_team', 'winning_team', 'division',
-                    'in_holding', 'at_ring', 'number', 'ring_assignment_time',
-                    'ring_number', 'round_num', 'round_slot', 'competing',),
-}
+def stream_gzipped(request):
+    """Returns whether the snapshot is sent to request streamed and
+    gzipped."""
+    return request.GET.get('stream') == '1' and bool(accepts_gzip_re.search(
+            request.META.get('HTTP_ACCEPT_ENCODING', '')))
 
+def tournament_json_etag(request, tournament_slug):
+    snapshot_version = models.Tournament.objects.filter(
+            slug=tournament_slug).values_list(
+            'snapshot_version', flat=True).first()
+    if snapshot_version is None:
+        return None
+    etag = "%d-%s" %(snapshot_version, get_snapshot_format(request))
+    # the gzipped response is a different representation, which needs an
+    # ETag of its own
+    if stream_gzipped(request):
+        etag += "-gzip"
+    return etag
+
+def stream_tournament_json(request, tournament, snapshot_format):
+    response = StreamingHttpResponse(
+            stream_snapshot_json(tournament, snapshot_format),
+            content_type="application/json")
+    if stream_gzipped(request):
+        response.streaming_content = compress_sequence(
+                response.streaming_content)
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+@vary_on_headers('Accept-Encoding')
+@condition(etag_func=tournament_json_etag)
 def tournament_json(request, tournament_slug):
-    msg = []
-    tournament = models.Tournament.objects.get(slug=tournament_slug)
-    msg.extend(model_to_json(
-            [tournament],
-            json_fields['tournament']))
-    msg.extend(model_to_json(
-            models.SparringDivision.objects.all(),
-            json_fields['division']))
-    msg.extend(model_to_json(
-            models.School.objects.all(),
-            json_fields['school']))
-    msg.extend(model_to_json(
-            models.SparringTeam.objects.all(),
-            json_fields['team']))
-    msg.extend(model_to_json(
-            models.TournamentSparringDivision.objects.filter(
-                    tournament=tournament),
-            json_fields['tournament_division']))
-    msg.extend(model_to_json(
-            models.SchoolTournamentRegistration.objects.filter(
-                    tournament=tournament),
-            json_fields['school_tournament_registration']))
-    msg.extend(model_to_json(
-            models.SchoolSeasonRegistration.objects.all(),
-            json_fields['school_season_registration']))
-    msg.extend(model_to_json(
-            models.SparringTeamRegistration.objects.filter(
-                    tournament_division__tournament=tournament),
-            json_fields['team_registration']))
-    msg.extend(model_to_json(
-            models.SparringTeamMatch.objects.filter(
-                    division__tournament=tournament),
-            json_fields['team_match']))
+    """Returns the snapshot of a tournament.
 
-    msg_json = json.dumps(msg)
-    return HttpResponse(msg_json, content_type="application/json")
+    The snapshot is a list of serialized model instances by default, or the
+    compact format of tmdb.snapshot if the format=compact query parameter
+    is given. The ETag of the response is the snapshot_version of the
+    tournament (and the format and content coding), so clients can
+    revalidate with If-None-Match.
+
+    With the stream=1 query parameter, the snapshot is encoded while it is
+    sent (gzipped if the client accepts it) instead of being served from
+    the cache, which bounds the memory used for very large tournaments."""
+    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
+    snapshot_format = get_snapshot_format(request)
+    if request.GET.get('stream') == '1':
+        response = stream_tournament_json(request, tournament,
+                snapshot_format)
+    else:
+        response = HttpResponse(get_snapshot_json(tournament,
+                snapshot_format), content_type="application/json")
+    patch_cache_control(response, no_cache=True)
+    return response
+
+def tournament_updates_json(request, tournament_slug):
+    """Returns the updates of a tournament after the sequence given by the
+    since query parameter, as {"seq": ..., "updates": [...]} where every
+    update is a match update websocket message. The ring, division and
+    school query parameters select the same subscriptions as for the
+    websocket.
+
+    If some of the updates are no longer available, the snapshot of the
+    tournament (in the format given by the format query parameter) is
+    returned instead."""
+    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
+    try:
+        since = int(request.GET['since'])
+    except (KeyError, ValueError):
+        return HttpResponse("Invalid since parameter", status=400)
+    subscription_keys = models.TournamentUpdate.parse_subscription_keys(
+            dict(request.GET.lists()))
+    updates = models.TournamentUpdate.updates_since(tournament, since,
+            subscription_keys)
+    if updates is None:
+        msg_json = get_snapshot_json(tournament, get_snapshot_format(request))
+    else:
+        msg_json = '{"seq":%d,"updates":[%s]}' %(tournament.snapshot_version,
+                ",".join(update.message_json() for update in updates))
+    response = HttpResponse(msg_json, content_type="application/json")
+    patch_cache_control(response, no_cache=True)
+    return response
 
 @login_required
 def tournament_school(request, tournament_slug, school_slug):
@@ -208,37 +268,57 @@ def tournament_school_import(request, tournament_slug, school_slug=None):
     if request.method != "POST":
         return HttpResponse("Invalid operation: %s on %s" %(request.method,
                 request.get_full_path()), status=405)
-    if school_slug is None:
-        school_regs = models.SchoolTournamentRegistration.objects.filter(
-                tournament__slug=tournament_slug)
-    else:
-        school_reg = get_object_or_404(models.SchoolTournamentRegistration,
-                tournament__slug=tournament_slug,
-                school_season_registration__school__slug=school_slug)
-        school_regs = [school_reg]
+    school_regs = models.SchoolTournamentRegistration.objects.filter(
+            tournament__slug=tournament_slug).select_related(
+            'tournament', 'school_season_registration__school')
+    if school_slug is not None:
+        school_regs = [get_object_or_404(school_regs,
+                school_season_registration__school__slug=school_slug)]
     reimport = False
     if request.POST.get('reimport') == "true":
         reimport = True
     err_msgs = []
     already_imported_schools = []
+    unchanged_schools = []
+    schools_to_import = []
     for school_reg in school_regs:
         if school_reg.imported and not reimport:
             already_imported_schools.append(
                     school_reg.school_season_registration.school.name)
             continue
+        schools_to_import.append(school_reg)
+    documents = []
+    if schools_to_import:
+        try:
+            documents = get_registration_source().fetch_all(
+                    schools_to_import)
+        except RegistrationSourceError as e:
+            err_msgs.append(str(e))
+    for school_reg, document, fetch_error in documents:
+        school_name = school_reg.school_season_registration.school.name
+        if fetch_error is not None:
+            err_msgs.append("Error importing %s: %s" %(school_name,
+                    str(fetch_error)))
+            continue
         try:
-            school_reg.import_competitors_and_teams(reimport=reimport)
+            imported = school_reg.import_competitors_and_teams(
+                    reimport=reimport, document=document)
         except models.SchoolValidationError as e:
-            err_msg = "Error importing %s: %s" %(
-                    school_reg.school_season_registration.school.name,
-                    str(e))
+            err_msg = "Error importing %s: %s" %(school_name, str(e))
             err_msgs.append(err_msg)
+            continue
+        if not imported:
+            unchanged_schools.append(school_name)
     for err_msg in err_msgs:
         messages.error(request, err_msg, extra_tags="alert alert-danger")
     if already_imported_schools:
         msg = "The following schools were not re-imported: %s" %(
                 ", ".join(already_imported_schools))
         messages.warning(request, msg, extra_tags="alert alert-warning")
+    if unchanged_schools:
+        msg = "The registrations of the following schools have not changed: %s" %(
+                ", ".join(unchanged_schools))
+        messages.info(request, msg, extra_tags="alert alert-info")
     return HttpResponseRedirect(reverse('tmdb:tournament_schools',
             args=(tournament_slug,)))
 